@@ -1,5 +1,6 @@
 import copy
 import collections
+import os
 
 class FrozenDict(collections.Mapping):
     """Don't forget the docstrings!!"""
@@ -29,13 +30,38 @@ class FrozenDict(collections.Mapping):
         return self._hash
 
 class Asset(object):
+	__slots__ = ('type', 'attr', 'flags')
+	INDEXES = None		# attribute -> fold function (or None), how Environment should index assets of this type
+	flagSTALE = 1		# we think it's there but haven't heard from it lately
 	def __init__(self, type):
 		self.type = type
 		self.attr = {}
+		self.flags = 0
 	def name(self):
 		pass
 	def close(self):
 		pass
+	def addFlag(self, flag):
+		self.flags |= flag
+	def delFlag(self, flag):
+		self.flags &= ~flag
+	def hasFlag(self, flag):
+		return (self.flags & flag) != 0
+
+	# a stable name for this asset across restarts, None if it shouldn't be kept in a catalog
+	def catalogKey(self):
+		return None
+	# after a restart, can we tell whether it's still there?  True, False, or None if only rediscovery can say
+	def revalidate(self):
+		return None
+	# take on the state of a newer copy of the same asset
+	def refreshFrom(self, other):
+		for cls in type(other).__mro__:
+			for name in getattr(cls, '__slots__', ()):
+				if name != 'flags' and hasattr(other, name):
+					setattr(self, name, getattr(other, name))
+		if hasattr(other, '__dict__'):
+			self.__dict__.update(other.__dict__)
 	def __repr__(self):
 		ourName = self.name()
 		if ourName is not None:
@@ -44,16 +70,26 @@ class Asset(object):
 			return '<' + self.type + '>'
 
 class Transform(object):
+	COST = 1.0			# relative expense of running this transform, used to rank chains
 	def __init__(self):
 		pass
 	def spec(self):
 		pass
+	def cost(self):
+		return self.COST
 	def newTask(self,env,input,output):
 		pass
 	def isRunning(self,tasks,input,output):
 		return False
+	# can our product be streamed straight into consumer, without ever being stored?
+	def canFuse(self, consumer):
+		return False
+	# one task doing our step and consumer's together, writing our product to intermediate only if it's given
+	def fuse(self, consumer, env, input, output, intermediate = None):
+		return None
 		
 class TransformSpec(object):
+	__slots__ = ('requires', 'consumes', 'locks', 'produces', 'transforms', 'extras')
 	def __init__(self, attr = {}):
 		self.requires = attr.get('requires', None)
 		if self.requires is not None:
@@ -99,6 +135,16 @@ class TransformSpec(object):
 			temp.extend(self.extras)
 			return hash(tuple(temp))
 
+	def shape(self):
+		names = {}
+		result = []
+		for phList in (self.requires, self.consumes, self.locks, self.produces):
+			if phList is None:
+				result.append(None)
+			else:
+				result.append(tuple([ph.shape(names) for ph in sorted(phList, key=AssetPlaceholder.shape)]))
+		return tuple(result)
+
 	def canProduce(self, asset):
 		if self.produces is None:
 			return None
@@ -312,6 +358,7 @@ class TransformSpec(object):
 		return newSpec
 		
 class AssetPlaceholder(Asset):
+	__slots__ = ()
 	def __init__(self, type, attr = None):
 		Asset.__init__(self, type)
 		if attr is not None:
@@ -319,7 +366,7 @@ class AssetPlaceholder(Asset):
 	def __repr__(self):
 		return '<' + self.type + ': ' + str(self.attr) + '>'
 	def __getattr__(self, name):
-		if name in self.attr:
+		if name != 'attr' and name in self.attr:
 			return self.attr[name]
 		raise AttributeError
 	def __ne__(self, other):
@@ -336,8 +383,24 @@ class AssetPlaceholder(Asset):
 	def __hash__(self):
 		hashResult = hash(self.type) ^ hash(len(self.attr))
 		for attr in self.attr:
-			hashResult = hashResult ^ hash(attr)
+			try:
+				hashResult = hashResult ^ hash((attr, self.attr[attr]))
+			except TypeError:
+				hashResult = hashResult ^ hash(attr)
 		return hashResult
+	def shape(self, names = None):
+		# a structural description of this placeholder, suitable for comparing across processes.  Any
+		# TransformPlaceholders are numbered in the order they're found in names (if specified)
+		result = []
+		for attr in sorted(self.attr):
+			value = self.attr[attr]
+			if not isinstance(value, TransformPlaceholder):
+				result.append((attr, repr(value)))
+			elif names is None:
+				result.append((attr, '?'))
+			else:
+				result.append((attr, '?%d' % names.setdefault(value, len(names))))
+		return (self.type, tuple(result))
 	def copy(self):
 		new = AssetPlaceholder(self.type)
 		new.attr = copy.copy(self.attr)
@@ -385,11 +448,62 @@ class TransformPlaceholder(object):
 	def __repr__(self):
 		return '<' + hex(id(self))[2:] + '>'
 
+class SpecTable(object):
+	"""Hash-conses specs and placeholders so equal ones are a single shared object, and remembers
+	the result of combining any two specs it has handed out"""
+	def __init__(self):
+		self.placeholders = {}
+		self.specs = {}
+		self.combined = {}		# (id(parent), id(child)) -> (parent, child, combined spec)
+
+	def placeholder(self, ph):
+		return self.placeholders.setdefault(ph, ph)
+
+	def spec(self, spec):
+		return self.specs.setdefault(spec, spec)
+
+	def combine(self, parent, child):
+		key = (id(parent), id(child))
+		found = self.combined.get(key)
+		if found is not None:
+			return found[2]
+		newSpec = parent.combineAsChild(child)
+		if newSpec in self.specs:
+			newSpec = self.specs[newSpec]
+		else:
+			# this is a fresh object nobody else has seen yet, so it's safe to swap in the shared placeholders
+			if newSpec.requires is not None:
+				newSpec.requires = frozenset([self.placeholder(ph) for ph in newSpec.requires])
+			if newSpec.consumes is not None:
+				newSpec.consumes = frozenset([self.placeholder(ph) for ph in newSpec.consumes])
+			if newSpec.locks is not None:
+				newSpec.locks = frozenset([self.placeholder(ph) for ph in newSpec.locks])
+			if newSpec.produces is not None:
+				newSpec.produces = frozenset([self.placeholder(ph) for ph in newSpec.produces])
+			self.specs[newSpec] = newSpec
+		self.combined[key] = (parent, child, newSpec)		# holding on to parent and child keeps their ids unique
+		return newSpec
+
 class ToolchainTransform(Transform):
+	TOOL = None			# the Tool this transform drives
 	def __init__(self):
-		self.toolPath = None
-	def callTool(self, cmd):
-		pass
+		Transform.__init__(self)
+		self.toolPath = None		# overrides where TOOL says to find it
+	def toolCommand(self):
+		if self.toolPath is not None:
+			return self.toolPath
+		if 'path' in self.TOOL.attr:
+			return os.path.join(self.TOOL.path, self.TOOL.cmd)
+		return self.TOOL.cmd
+	# a task that runs the tool with these arguments once the controller has a cpu slot for it
+	def callTool(self, args, input = None, onComplete = None):
+		import task
+		return task.ToolTask(self, [self.toolCommand()] + list(args), input, onComplete)
+	def isRunning(self,tasks,input,output):
+		for task in tasks:
+			if task.input == input and task.status in (task.tsQUEUED, task.tsRUNNING):
+				return True
+		return False
 	
 class Tool(Asset):
 	def __init__(self, attr):
@@ -402,21 +516,94 @@ class Tool(Asset):
 			return self.attr[name]
 		raise AttributeError
 	
+def foldCase(value):
+	if isinstance(value, basestring):
+		return value.lower()
+	return value
+
 class Environment(object):
 	def __init__(self):
 		self.assetsByType = {}
+		self.indexes = {}			# asset type -> {attr: fold function}
+		self.assetIndex = {}		# (asset type, attr, folded value) -> set of assets
+		self.assetKeys = {}			# asset -> {attr: assetIndex key it is filed under}
 		
 	def declareAsset(self, obj):
 		if obj.type not in self.assetsByType:
 			self.assetsByType[obj.type] = set()
 		if obj not in self.assetsByType[obj.type]:
 			self.assetsByType[obj.type].add(obj)
+			self.indexAsset(obj)
+		return obj
 
 	def undeclareAsset(self, obj):
 		if obj.type in self.assetsByType and obj in self.assetsByType[obj.type]:
 			self.assetsByType[obj.type].remove(obj)
+			self.unindexAsset(obj)
 
 	def getAssetsByType(self, type):
 		if type in self.assetsByType:
 	 		return set(self.assetsByType[type])
-		return None
\ No newline at end of file
+		return None
+
+	def indexAsset(self, obj):
+		indexes = self.indexes.setdefault(obj.type, {})
+		if obj.INDEXES:
+			newIndexes = [attr for attr in obj.INDEXES if attr not in indexes]
+			if newIndexes:
+				for attr in newIndexes:
+					indexes[attr] = obj.INDEXES[attr]
+				for other in self.assetsByType.get(obj.type, ()):
+					self.__fileAsset(other)
+		self.__fileAsset(obj)
+
+	def unindexAsset(self, obj):
+		for key in self.assetKeys.pop(obj, {}).itervalues():
+			assets = self.assetIndex[key]
+			assets.discard(obj)
+			if not assets:
+				del self.assetIndex[key]
+
+	# start indexing assets of the specified type by an attribute, including the ones we already have
+	def addIndex(self, type, attr, fold = None):
+		self.indexes.setdefault(type, {})[attr] = fold
+		for obj in self.assetsByType.get(type, ()):
+			self.__fileAsset(obj)
+
+	def __fileAsset(self, obj):
+		keys = self.assetKeys.setdefault(obj, {})
+		for attr in self.indexes[obj.type]:
+			if attr in obj.attr and attr not in keys:
+				key = self.indexKey(obj.type, attr, obj.attr[attr])
+				self.assetIndex.setdefault(key, set()).add(obj)
+				keys[attr] = key
+
+	def indexKey(self, type, attr, value):
+		fold = self.indexes[type][attr]
+		if fold is not None:
+			value = fold(value)
+		return (type, attr, value)
+
+	# the smallest set of assets that could contain everything satisfying this placeholder
+	def candidateAssets(self, phAsset):
+		assets = self.assetsByType.get(phAsset.type)
+		if not assets:
+			return ()
+		indexes = self.indexes.get(phAsset.type)
+		if indexes:
+			for attr in phAsset.attr:
+				value = phAsset.attr[attr]
+				if attr in indexes and not isinstance(value, TransformPlaceholder):
+					found = self.assetIndex.get(self.indexKey(phAsset.type, attr, value), ())
+					if len(found) < len(assets):
+						assets = found
+		return tuple(assets)
+
+	def findAsset(self, phAsset):
+		for asset in self.candidateAssets(phAsset):
+			if asset.satisfies(phAsset):
+				return asset
+		return None
+
+	def findAssets(self, phAsset):
+		return [asset for asset in self.candidateAssets(phAsset) if asset.satisfies(phAsset)]
@@ -0,0 +1,147 @@
+'''Durable asset catalog
+
+CatalogEnvironment is an ObservableEnvironment that keeps every asset
+with a catalogKey() in an SQLite file, so a restart begins with what we
+knew last time instead of waiting for beacons and listings.  Restored
+assets are flagged stale until they're declared again by whatever
+discovers them.
+'''
+
+import sqlite3, cPickle, cStringIO, threading
+import base, task
+from base import Asset
+
+class CatalogEnvironment(task.ObservableEnvironment):
+	FLUSH_INTERVAL = 2.0		# seconds a write may wait to be batched with others
+	FLUSH_SIZE     = 500		# flush straight away once this many writes are waiting
+
+	def __init__(self, filename):
+		task.ObservableEnvironment.__init__(self)
+		self.filename = filename
+		self.lock = threading.RLock()
+		self.byKey = {}				# catalog key -> declared asset
+		self.pending = {}			# catalog key -> asset to write, or None to delete
+		self.flushTimer = None
+		self.db = sqlite3.connect(filename, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS assets (key TEXT PRIMARY KEY, type TEXT NOT NULL, data BLOB NOT NULL)')
+		self.db.commit()
+		self.load()
+
+	def close(self):
+		self.flush()
+		with self.lock:
+			self.db.close()
+
+	# returns the asset that's now in the catalog, which is an earlier (restored) copy if there is one
+	def declareAsset(self, obj):
+		key = obj.catalogKey()
+		if key is None:
+			return task.ObservableEnvironment.declareAsset(self, obj)
+		with self.lock:
+			existing = self.byKey.get(key)
+			if existing is not None and existing is not obj:
+				self.unindexAsset(existing)
+				existing.refreshFrom(obj)
+				existing.delFlag(Asset.flagSTALE)
+				self.indexAsset(existing)
+				self.queueWrite(key, existing)
+				return existing
+			self.byKey[key] = obj
+			self.queueWrite(key, obj)
+		return task.ObservableEnvironment.declareAsset(self, obj)
+
+	def undeclareAsset(self, obj):
+		key = obj.catalogKey()
+		if key is not None:
+			with self.lock:
+				if self.byKey.get(key) is obj:
+					del self.byKey[key]
+					self.queueWrite(key, None)
+		task.ObservableEnvironment.undeclareAsset(self, obj)
+
+	def queueWrite(self, key, obj):
+		with self.lock:
+			self.pending[key] = obj
+			if len(self.pending) >= self.FLUSH_SIZE:
+				self.flush()
+			elif self.flushTimer is None:
+				self.flushTimer = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+				self.flushTimer.daemon = True
+				self.flushTimer.start()
+
+	# write everything waiting in one transaction
+	def flush(self):
+		with self.lock:
+			if self.flushTimer is not None:
+				self.flushTimer.cancel()
+				self.flushTimer = None
+			if not self.pending:
+				return
+			writes = []
+			deletes = []
+			for key, obj in self.pending.iteritems():
+				if obj is None:
+					deletes.append((key,))
+				else:
+					writes.append((key, obj.type, buffer(self.dumps(obj))))
+			self.pending = {}
+			with self.db:
+				if deletes:
+					self.db.executemany('DELETE FROM assets WHERE key = ?', deletes)
+				if writes:
+					self.db.executemany('INSERT OR REPLACE INTO assets (key, type, data) VALUES (?, ?, ?)', writes)
+
+	# other catalogued assets an asset refers to are stored by key, so they come back as the same object
+	def dumps(self, obj):
+		def persistentId(other):
+			if other is not obj and isinstance(other, Asset) and not isinstance(other, base.AssetPlaceholder):
+				return other.catalogKey()
+			return None
+		buf = cStringIO.StringIO()
+		pickler = cPickle.Pickler(buf, cPickle.HIGHEST_PROTOCOL)
+		pickler.persistent_id = persistentId
+		pickler.dump(obj)
+		return buf.getvalue()
+
+	def load(self):
+		with self.lock:
+			rows = {}
+			for key, type, data in self.db.execute('SELECT key, type, data FROM assets'):
+				rows[key] = str(data)
+		restored = {}
+		def restore(key):
+			if key not in restored:
+				restored[key] = None		# anything that refers back to itself is broken
+				unpickler = cPickle.Unpickler(cStringIO.StringIO(rows[key]))
+				unpickler.persistent_load = restoreRef
+				restored[key] = unpickler.load()
+			return restored[key]
+		def restoreRef(key):
+			if key not in rows:
+				raise KeyError(key)
+			obj = restore(key)
+			if obj is None:
+				raise KeyError(key)
+			return obj
+		dropped = []
+		for key in rows:
+			try:
+				obj = restore(key)
+			except Exception:
+				dropped.append(key)
+				continue
+			valid = obj.revalidate()
+			if valid is None:
+				obj.addFlag(Asset.flagSTALE)
+			elif not valid:
+				dropped.append(key)
+				continue
+			else:
+				obj.delFlag(Asset.flagSTALE)
+			self.byKey[key] = obj
+			task.ObservableEnvironment.declareAsset(self, obj)
+		for key in dropped:
+			self.queueWrite(key, None)
+		print "%d assets restored from %s (%d dropped)" % (len(self.byKey), self.filename, len(dropped))
@@ -0,0 +1,91 @@
+'''Checks for behaviour that has been broken before
+
+Each check builds what it needs in a temporary directory, prints ok or
+FAILED with what it saw, and the script exits non-zero if any failed.
+
+usage: python checks.py
+'''
+
+import sys, os, shutil, tempfile
+import base, task, tivo, storage, dbdict
+
+class HeldController(task.TaskController):
+	"""Queues tasks but never starts any, so nothing goes near the network"""
+	def admissible(self, task):
+		return False
+
+# a goal evaluated again (as it is whenever an asset comes or goes) mustn't queue a download that's already queued
+def checkGoalQueuesOnce(tempDir):
+	env = task.ObservableEnvironment()
+	server = tivo.TivoServer({'identity': 'check'})
+	server.mediaKey = server.attr['mediaKey'] = '0123456789'		# what the listener doesn't fill in yet
+	env.declareAsset(server)
+	video = tivo.TivoVideo(1, server, {'Details': {'Title': 'Check', 'ProgramId': 'EP0000000001', 'SourceSize': 1000},
+		'Links': {'Content': {'Url': 'http://127.0.0.1:1/check'}}})
+	env.declareAsset(video)
+	downloader = [xform for xform in task.avail_transforms if isinstance(xform, tivo.DownloadTivoVideo)][0]
+	downloader.storage = storage.StoragePool([tempDir], margin = 0)
+	tasks = HeldController(env)
+	try:
+		goalTask = task.GoalTask(env, task.Goal(base.AssetPlaceholder('TivoVideoDownload', {'title': 'Check'})))
+		goalTask.start(tasks)
+		goalTask.evaluate()
+		downloads = [queued for queued in tasks.tasks if isinstance(queued, tivo.TivoDownload)]
+		return len(downloads) == 1, '%d downloads queued' % len(downloads)
+	finally:
+		downloader.storage = None
+		tasks.stop()
+
+# a goal that stopped queueing because the controller was full picks up again when a task finishes
+def checkGoalResumesWhenFull(tempDir):
+	env = task.ObservableEnvironment()
+	server = tivo.TivoServer({'identity': 'check'})
+	server.mediaKey = server.attr['mediaKey'] = '0123456789'
+	env.declareAsset(server)
+	for tivoId in (1, 2, 3):
+		env.declareAsset(tivo.TivoVideo(tivoId, server, {'Details': {'Title': 'Check', 'ProgramId': 'EP000000000%d' % tivoId, 'SourceSize': 1000},
+			'Links': {'Content': {'Url': 'http://127.0.0.1:1/check?id=%d' % tivoId}}}))
+	downloader = [xform for xform in task.avail_transforms if isinstance(xform, tivo.DownloadTivoVideo)][0]
+	downloader.storage = storage.StoragePool([tempDir], margin = 0)
+	tasks = HeldController(env, maxTasks = 2)
+	def unfinished():
+		return [queued for queued in tasks.tasks if queued.status not in task.Task.FINISHED]
+	try:
+		goalTask = task.GoalTask(env, task.Goal(base.AssetPlaceholder('TivoVideoDownload', {'title': 'Check'})))
+		goalTask.start(tasks)
+		before = len(unfinished())
+		unfinished()[0].statusChanged(task.Task.tsCOMPLETE)
+		tasks.handleMessages()
+		after = len(unfinished())
+		return before == 2 and after == 2, '%d unfinished, %d after one completed' % (before, after)
+	finally:
+		downloader.storage = None
+		tasks.stop()
+
+# opening 'n' starts empty, journalled or not, and stays empty once reopened
+def checkNewForgetsOld(tempDir):
+	filename = os.path.join(tempDir, 'check.db')
+	db = dbdict.dbopen(filename)
+	db['old'] = '1'
+	db.close()
+	db = dbdict.dbopen(filename, 'n', journal=True)
+	db['new'] = '2'
+	db.close()
+	db = dbdict.dbopen(filename, 'c', journal=True)
+	contents = dict(db)
+	db.close()
+	return contents == {'new': '2'}, 'reopened as %r' % contents
+
+CHECKS = [checkGoalQueuesOnce, checkGoalResumesWhenFull, checkNewForgetsOld]
+
+if __name__ == '__main__':
+	failed = 0
+	for check in CHECKS:
+		tempDir = tempfile.mkdtemp(prefix='check')
+		try:
+			passed, detail = check(tempDir)
+		finally:
+			shutil.rmtree(tempDir)
+		print '%-28s %s (%s)' % (check.__name__, passed and 'ok' or 'FAILED', detail)
+		failed += not passed
+	sys.exit(failed and 1 or 0)
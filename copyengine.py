@@ -0,0 +1,119 @@
+'''Block copier for the copy tasks
+
+CopyEngine moves bytes from one file object to another by the cheapest
+way the pair allows: in the kernel with splice()/sendfile() when the
+source is a regular file and the destination will take it, otherwise
+through one preallocated buffer with readinto(), and only for sources
+without readinto() (HTTP responses, say) a fresh string per block.
+
+usage: python copyengine.py [megabytes]
+'''
+
+import os, sys, stat, time, tempfile, threading
+import pipesubproc
+
+class CopyEngine(object):
+	KERNEL, READINTO, READ = 'kernel', 'readinto', 'read'
+
+	def __init__(self, src, dest, paths = (KERNEL, READINTO, READ)):
+		self.src = src
+		self.dest = dest
+		self.buffer = None
+		self.view = None
+		self.offset = None			# where the kernel path has got to in src
+		self.path = self.choosePath(paths)
+
+	def choosePath(self, paths):
+		if self.KERNEL in paths and hasattr(pipesubproc, 'kernel_send'):
+			try:
+				self.srcFd = self.src.fileno()
+				self.destFd = self.dest.fileno()
+				regular = stat.S_ISREG(os.fstat(self.srcFd).st_mode)
+			except (AttributeError, IOError, OSError, ValueError):
+				regular = False
+			if regular:
+				# the file objects may be holding data on either side of the fds, so start where they say
+				self.offset = self.src.tell()
+				self.dest.flush()
+				return self.KERNEL
+		if self.READINTO in paths and hasattr(self.src, 'readinto'):
+			return self.READINTO
+		return self.READ
+
+	# copy up to count bytes, returning how many went (0 at the end of src)
+	def copy(self, count):
+		if self.path == self.KERNEL:
+			moved = pipesubproc.kernel_send(self.srcFd, self.destFd, self.offset, count)
+			if moved is not None:
+				self.offset += moved
+				self.src.seek(self.offset)		# keep src's own idea of where it is honest
+				return moved
+			# the kernel won't do it for this pair (an O_APPEND destination, say), and won't next time either
+			self.src.seek(self.offset)
+			self.path = self.READINTO if hasattr(self.src, 'readinto') else self.READ
+		if self.path == self.READINTO:
+			if self.buffer is None or len(self.buffer) < count:
+				self.buffer = bytearray(count)		# only grows, so a steady block size allocates once
+				self.view = memoryview(self.buffer)
+			got = self.src.readinto(self.view[:count])
+			if got:
+				self.dest.write(self.view[:got])
+			return got or 0
+		buf = self.src.read(count)
+		self.dest.write(buf)
+		return len(buf)
+
+###############################################################################
+
+def benchmark(megabytes):
+	block = 1024 * 1024
+	size = megabytes * block
+	fd, srcName = tempfile.mkstemp(prefix='copybench')
+	chunk = os.urandom(block)
+	with os.fdopen(fd, 'wb') as f:
+		for idx in xrange(megabytes):
+			f.write(chunk)
+	destName = srcName + '.out'
+
+	def toFile(paths):
+		with open(srcName, 'rb') as src:
+			with open(destName, 'wb') as dest:
+				return run(CopyEngine(src, dest, paths))
+	def toPipe(paths):
+		readFd, writeFd = os.pipe()
+		pipesubproc.enlarge_pipe(writeFd)
+		def drain():
+			while os.read(readFd, block):
+				pass
+		drainer = threading.Thread(target=drain)
+		drainer.start()
+		try:
+			with open(srcName, 'rb') as src:
+				with os.fdopen(writeFd, 'wb', 0) as dest:
+					return run(CopyEngine(src, dest, paths))
+		finally:
+			drainer.join()
+			os.close(readFd)
+	def run(engine):
+		start = time.time()
+		while engine.copy(block):
+			pass
+		return engine.path, time.time() - start
+
+	try:
+		print '%d MB, %d KB blocks' % (megabytes, block / 1024)
+		print '%-6s %-10s %10s' % ('to', 'path', 'MB/s')
+		for label, target in (('file', toFile), ('pipe', toPipe)):
+			for paths in ((CopyEngine.READ,), (CopyEngine.READINTO,), (CopyEngine.KERNEL,)):
+				path, elapsed = target(paths)
+				print '%-6s %-10s %10.1f' % (label, path, megabytes / elapsed)
+	finally:
+		for name in (srcName, destName):
+			if os.path.exists(name):
+				os.remove(name)
+
+if __name__ == '__main__':
+	megabytes = 256
+	if len(sys.argv) > 1:
+		megabytes = int(sys.argv[1])
+	benchmark(megabytes)
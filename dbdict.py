@@ -6,38 +6,132 @@ While open, the whole dict is kept in memory.  Start-up and
 close time's are potentially long because the whole dict must be
 read or written to disk.
 
-Input file format is automatically discovered.
-Output file format is selectable between pickle, json, and csv.
-All three are backed by fast C implementations.
+Output file format is selectable between pickle, json, csv, and
+binary (length-prefixed key/value records that stream both ways).
+Files start with a magic number, version and format code, so loading
+knows the format straight away; files from before the header are
+still discovered by trial and error.
+
+In journal mode, changes are appended to filename.journal instead, so
+sync() only writes what changed since the last one.  The snapshot is
+rewritten in the background once the journal outgrows it, and loading
+replays the journal over the snapshot.
+
+For stores too big to read up front there's ShardedDictDB, which keeps
+its keys spread over hash-sharded files in a directory.  A shard's key
+index is read the first time one of its keys is wanted, values stay in
+the memory-mapped shard file until they're asked for, and sync() only
+rewrites the shards that changed.
 
 '''
 
-import pickle, json, csv
-import os, shutil
+import cPickle, json, csv, collections, mmap, zlib
+import os, shutil, struct, threading, Queue, __builtin__
 
 class DictDB(dict):
+    MAGIC = 'DictDB\x00'
+    VERSION = 1
+    FORMATS = ('csv', 'json', 'pickle', 'binary')   # position is the format's code in the file header
+    FILE_HEADER = struct.Struct('>7sBB')            # magic, version, format code
+    BINARY_RECORD = struct.Struct('>BII')           # flags, key length, value length
+    KEY_PICKLED, VALUE_PICKLED = 1, 2               # binary record flags, for anything that isn't a str
+    BINARY_CHUNK = 1024 * 1024                      # how much of a binary file to read or write at a time
+    COMPACT_MIN = 64 * 1024                 # journals smaller than this are never worth compacting
+    RECORD_HEADER = struct.Struct('>I')     # journal records are a length followed by a pickle
 
-    def __init__(self, filename, flag=None, mode=None, format=None, *args, **kwds):
+    def __init__(self, filename, flag=None, mode=None, format=None, journal=False, compactRatio=2.0, *args, **kwds):
         self.flag = flag or 'c'             # r=readonly, c=create, or n=new
         self.mode = mode                    # None or octal triple like 0x666
-        self.format = format or 'csv'       # csv, json, or pickle
+        self.format = format or 'csv'       # csv, json, pickle, or binary
         self.filename = filename
-        if flag != 'n' and os.access(filename, os.R_OK):
-            file = __builtins__.open(filename, 'rb')
+        self.journal = journal
+        self.compactRatio = compactRatio    # compact once the journal is this many times the size of the snapshot
+        self.tail = None                    # changes not yet in the journal, None while not journalling
+        self.lock = threading.RLock()
+        self.journalFile = None
+        self.journalSize = 0
+        self.snapshotSize = 0
+        self.compactor = None
+        if flag == 'n':
+            # a journal only records changes, so an old snapshot left behind would come back under it
+            for name in (filename, self.journalName(), self.journalName() + '.old'):
+                if os.path.exists(name):
+                    os.remove(name)
+        elif os.access(filename, os.R_OK):
+            file = __builtin__.open(filename, 'rb')
             try:
                 self.load(file)
             finally:
                 file.close()
+            self.snapshotSize = os.path.getsize(filename)
+        if journal:
+            self.replay(self.journalName() + '.old')
+            self.journalSize = self.replay(self.journalName())
+            self.tail = []
         self.update(*args, **kwds)
 
+    def journalName(self):
+        return self.filename + '.journal'
+
+    # record mutations while journalling (dict's own update() and friends don't go through __setitem__)
+    def __setitem__(self, key, value):
+        with self.lock:
+            dict.__setitem__(self, key, value)
+            if self.tail is not None:
+                self.tail.append(('s', key, value))
+
+    def __delitem__(self, key):
+        with self.lock:
+            dict.__delitem__(self, key)
+            if self.tail is not None:
+                self.tail.append(('d', key, None))
+
+    def update(self, *args, **kwds):
+        for key, value in dict(*args, **kwds).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self and default:
+                return default[0]
+            value = self[key]
+            del self[key]
+            return value
+
+    def popitem(self):
+        with self.lock:
+            key, value = dict.popitem(self)
+            if self.tail is not None:
+                self.tail.append(('d', key, None))
+            return key, value
+
+    def clear(self):
+        with self.lock:
+            dict.clear(self)
+            if self.tail is not None:
+                self.tail = [('c', None, None)]
+
     def sync(self):
         if self.flag == 'r':
             return
+        if self.journal:
+            return self.syncJournal()
+        self.writeSnapshot(self.items())
+
+    def writeSnapshot(self, items):
         filename = self.filename
         tempname = filename + '.tmp'
-        file = __builtins__.open(tempname, 'wb')
+        file = __builtin__.open(tempname, 'wb')
         try:
-            self.dump(file)
+            self.dump(file, items)
+            file.flush()
+            os.fsync(file.fileno())
         except Exception:
             file.close()
             os.remove(tempname)
@@ -46,46 +140,449 @@ class DictDB(dict):
         shutil.move(tempname, self.filename)    # atomic commit
         if self.mode is not None:
             os.chmod(self.filename, self.mode)
+        return os.path.getsize(self.filename)
+
+    # append everything since the last sync to the journal, then compact if it's grown too big
+    def syncJournal(self):
+        with self.lock:
+            if self.tail:
+                records = ''.join(self.packRecord(record) for record in self.tail)
+                self.tail = []
+                if self.journalFile is None:
+                    self.journalFile = __builtin__.open(self.journalName(), 'ab')
+                self.journalFile.write(records)
+                self.journalFile.flush()
+                os.fsync(self.journalFile.fileno())
+                self.journalSize += len(records)
+            if self.compactor is None and self.journalSize > max(self.COMPACT_MIN, self.snapshotSize * self.compactRatio):
+                self.startCompaction()
+
+    def packRecord(self, record):
+        data = cPickle.dumps(record, -1)
+        return self.RECORD_HEADER.pack(len(data)) + data
+
+    # the journal so far becomes .journal.old, and a thread folds it into a new snapshot
+    # (if we die part way, loading replays .journal.old again, which comes out the same)
+    def startCompaction(self):
+        items = self.items()
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
+        oldName = self.journalName() + '.old'
+        if os.path.exists(oldName):
+            # an earlier compaction didn't finish, so that journal still counts
+            journal = __builtin__.open(self.journalName(), 'rb')
+            old = __builtin__.open(oldName, 'ab')
+            try:
+                shutil.copyfileobj(journal, old)
+                old.flush()
+                os.fsync(old.fileno())
+            finally:
+                journal.close()
+                old.close()
+            os.remove(self.journalName())
+        else:
+            os.rename(self.journalName(), oldName)
+        self.journalSize = 0
+        self.compactor = threading.Thread(target=self.compact, args=(items,), name='DictDB compaction')
+        self.compactor.start()
+
+    def compact(self, items):
+        try:
+            size = self.writeSnapshot(items)
+            os.remove(self.journalName() + '.old')
+            with self.lock:
+                self.snapshotSize = size
+        finally:
+            with self.lock:
+                self.compactor = None
+
+    # apply the journal at filename to the dict, returning how many bytes of it were good
+    def replay(self, filename):
+        if not os.access(filename, os.R_OK):
+            return 0
+        file = __builtin__.open(filename, 'rb')
+        try:
+            data = file.read()
+        finally:
+            file.close()
+        pos = 0
+        while pos + self.RECORD_HEADER.size <= len(data):
+            length, = self.RECORD_HEADER.unpack_from(data, pos)
+            end = pos + self.RECORD_HEADER.size + length
+            if end > len(data):
+                break       # torn write at the end, everything before it is still good
+            op, key, value = cPickle.loads(data[pos + self.RECORD_HEADER.size:end])
+            if op == 's':
+                dict.__setitem__(self, key, value)
+            elif op == 'd':
+                dict.pop(self, key, None)
+            elif op == 'c':
+                dict.clear(self)
+            pos = end
+        if pos < len(data) and self.flag != 'r':
+            file = __builtin__.open(filename, 'r+b')
+            try:
+                file.truncate(pos)
+            finally:
+                file.close()
+        return pos
 
     def close(self):
         self.sync()
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
 
-    def dump(self, file):
+    def dump(self, file, items=None):
+        if items is None:
+            items = self.items()
+        if self.format not in self.FORMATS:
+            raise NotImplementedError('Unknown format: %r' % self.format)
+        file.write(self.FILE_HEADER.pack(self.MAGIC, self.VERSION, self.FORMATS.index(self.format)))
         if self.format == 'csv':
-            csv.writer(file).writerows(self.iteritems())
+            csv.writer(file).writerows(items)
         elif self.format == 'json':
-            json.dump(self, file, separators=(',', ':'))
+            json.dump(dict(items), file, separators=(',', ':'))
         elif self.format == 'pickle':
-            pickle.dump(self.items(), file, -1)
-        else:
-            raise NotImplementedError('Unknown format: %r' % self.format)
+            cPickle.dump(items, file, -1)
+        elif self.format == 'binary':
+            self.dumpBinary(file, items)
+
+    def dumpBinary(self, file, items):
+        pack = self.BINARY_RECORD.pack
+        chunk = []
+        chunkSize = 0
+        for key, value in items:
+            flags = 0
+            if not isinstance(key, str):
+                key = cPickle.dumps(key, -1)
+                flags |= self.KEY_PICKLED
+            if not isinstance(value, str):
+                value = cPickle.dumps(value, -1)
+                flags |= self.VALUE_PICKLED
+            chunk.append(pack(flags, len(key), len(value)))
+            chunk.append(key)
+            chunk.append(value)
+            chunkSize += len(key) + len(value)
+            if chunkSize >= self.BINARY_CHUNK:
+                file.write(''.join(chunk))
+                chunk = []
+                chunkSize = 0
+        file.write(''.join(chunk))
+
+    def loadBinary(self, file):
+        unpack = self.BINARY_RECORD.unpack_from
+        headerSize = self.BINARY_RECORD.size
+        buf, pos = '', 0
+        while True:
+            if len(buf) - pos < headerSize:
+                buf, pos = buf[pos:] + file.read(self.BINARY_CHUNK), 0
+                if not buf:
+                    return
+                if len(buf) < headerSize:
+                    raise ValueError('Truncated record in %r' % self.filename)
+            flags, keyLength, valueLength = unpack(buf, pos)
+            end = pos + headerSize + keyLength + valueLength
+            if end > len(buf):
+                needed = end - len(buf)
+                buf, pos = buf[pos:] + file.read(max(self.BINARY_CHUNK, needed)), 0
+                end = headerSize + keyLength + valueLength
+                if end > len(buf):
+                    raise ValueError('Truncated record in %r' % self.filename)
+            keyEnd = pos + headerSize + keyLength
+            key = buf[pos + headerSize:keyEnd]
+            value = buf[keyEnd:end]
+            pos = end
+            if flags & self.KEY_PICKLED:
+                key = cPickle.loads(key)
+            if flags & self.VALUE_PICKLED:
+                value = cPickle.loads(value)
+            yield key, value
 
     def load(self, file):
-        # try formats from most restrictive to least restrictive
-        for loader in (pickle.load, json.load, csv.reader):
+        header = file.read(self.FILE_HEADER.size)
+        if len(header) == self.FILE_HEADER.size and header.startswith(self.MAGIC):
+            magic, version, code = self.FILE_HEADER.unpack(header)
+            if version > self.VERSION or code >= len(self.FORMATS):
+                raise ValueError('%r was written by a newer version (%d, format %d)' % (self.filename, version, code))
+            format = self.FORMATS[code]
+            if format == 'csv':
+                return dict.update(self, csv.reader(file))
+            elif format == 'json':
+                return dict.update(self, json.load(file))
+            elif format == 'pickle':
+                return dict.update(self, cPickle.load(file))
+            return dict.update(self, self.loadBinary(file))
+        # no header, so it's from before we had one: try formats from most restrictive to least restrictive
+        for loader in (cPickle.load, json.load, csv.reader):
             file.seek(0)
             try:
-                return self.update(loader(file))
+                return dict.update(self, loader(file))
             except Exception:
                 pass
         raise ValueError('File not in recognized format')
 
 
-def dbopen(filename, flag=None, mode=None, format=None):
-    return DictDB(filename, flag, mode, format)
+class ShardedDictDB(collections.MutableMapping):
+    SHARDS = 64
+    DELETED = object()          # marks a key deleted since the last sync
+
+    def __init__(self, dirname, flag=None, mode=None, shards=None):
+        self.flag = flag or 'c'             # r=readonly, c=create, or n=new
+        self.mode = mode                    # None or octal triple like 0x666
+        self.dirname = dirname
+        self.lock = threading.RLock()
+        self.indexes = {}           # shard -> {key: (offset, length)}, for the shards read so far
+        self.dataNames = {}         # shard -> name of its current data file
+        self.maps = {}              # shard -> mmap of its data file (or '' if it's empty)
+        self.cache = {}             # key -> value, for the values decoded so far
+        self.dirty = {}             # key -> value (or DELETED) not yet synced
+        if self.flag == 'n' and os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+        metaName = os.path.join(dirname, 'meta')
+        if os.path.exists(metaName):
+            file = __builtin__.open(metaName, 'rb')
+            try:
+                self.shards = int(file.read())
+            finally:
+                file.close()
+        elif self.flag == 'r':
+            raise IOError('No sharded store at %r' % dirname)
+        else:
+            self.shards = shards or self.SHARDS
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            file = __builtin__.open(metaName, 'wb')
+            try:
+                file.write(str(self.shards))
+            finally:
+                file.close()
+
+    # has to come out the same in every process, so no hash()
+    def shardOf(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, str):
+            raise TypeError('ShardedDictDB keys must be strings, not %r' % type(key))
+        return (zlib.crc32(key) & 0xffffffff) % self.shards
+
+    def indexName(self, shard):
+        return os.path.join(self.dirname, 'shard-%03d.idx' % shard)
+
+    def index(self, shard):
+        with self.lock:
+            if shard not in self.indexes:
+                self.loadShard(shard)
+            return self.indexes[shard]
+
+    def loadShard(self, shard):
+        dataName, index = None, {}
+        if os.path.exists(self.indexName(shard)):
+            file = __builtin__.open(self.indexName(shard), 'rb')
+            try:
+                dataName, index = cPickle.load(file)
+            finally:
+                file.close()
+        data = ''
+        if dataName is not None and index:
+            file = __builtin__.open(os.path.join(self.dirname, dataName), 'rb')
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                file.close()        # the map keeps its own handle
+        with self.lock:
+            if shard not in self.indexes:
+                self.indexes[shard] = index
+                self.dataNames[shard] = dataName
+                self.maps[shard] = data
+            elif data:
+                data.close()        # somebody else got there first
+
+    # read the key indexes of every shard now, using a few threads to overlap the I/O
+    def load(self, threads=4):
+        pending = Queue.Queue()
+        for shard in range(self.shards):
+            if shard not in self.indexes:
+                pending.put(shard)
+        def loader():
+            while True:
+                try:
+                    shard = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                self.loadShard(shard)
+        workers = [threading.Thread(target=loader, name='ShardedDictDB load') for idx in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.dirty:
+                value = self.dirty[key]
+                if value is self.DELETED:
+                    raise KeyError(key)
+                return value
+            if key in self.cache:
+                return self.cache[key]
+            shard = self.shardOf(key)
+            offset, length = self.index(shard)[key]
+            value = cPickle.loads(self.maps[shard][offset:offset + length])
+            self.cache[key] = value
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.dirty:
+                return self.dirty[key] is not self.DELETED
+            return key in self.index(self.shardOf(key))
+
+    def __setitem__(self, key, value):
+        if self.flag == 'r':
+            raise IOError('ShardedDictDB opened read-only')
+        self.shardOf(key)           # refuse keys we couldn't shard
+        with self.lock:
+            self.dirty[key] = value
+            self.cache.pop(key, None)
+
+    def __delitem__(self, key):
+        if self.flag == 'r':
+            raise IOError('ShardedDictDB opened read-only')
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.dirty[key] = self.DELETED
+            self.cache.pop(key, None)
+
+    # these need every shard's index
+    def __iter__(self):
+        self.load()
+        with self.lock:
+            keys = set()
+            for index in self.indexes.itervalues():
+                keys.update(index)
+            for key, value in self.dirty.iteritems():
+                if value is self.DELETED:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    # rewrite the shards with unsynced changes, copying untouched values across without decoding them
+    def sync(self):
+        if self.flag == 'r':
+            return
+        with self.lock:
+            byShard = {}
+            for key, value in self.dirty.iteritems():
+                byShard.setdefault(self.shardOf(key), {})[key] = value
+            for shard, changes in byShard.iteritems():
+                self.writeShard(shard, changes)
+            self.dirty = {}
 
+    def writeShard(self, shard, changes):
+        index = self.index(shard)
+        data = self.maps[shard]
+        generation = 0
+        if self.dataNames[shard] is not None:
+            generation = int(self.dataNames[shard].split('.')[1]) + 1
+        dataName = 'shard-%03d.%d.dat' % (shard, generation)
+        newIndex = {}
+        file = __builtin__.open(os.path.join(self.dirname, dataName), 'wb')
+        try:
+            offset = 0
+            for key, (start, length) in index.iteritems():
+                if key not in changes:
+                    file.write(data[start:start + length])
+                    newIndex[key] = (offset, length)
+                    offset += length
+            for key, value in changes.iteritems():
+                if value is not self.DELETED:
+                    encoded = cPickle.dumps(value, -1)
+                    file.write(encoded)
+                    newIndex[key] = (offset, len(encoded))
+                    offset += len(encoded)
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+        tempname = self.indexName(shard) + '.tmp'
+        file = __builtin__.open(tempname, 'wb')
+        try:
+            cPickle.dump((dataName, newIndex), file, -1)
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+        shutil.move(tempname, self.indexName(shard))     # atomic commit, the old data file is garbage from here
+        if self.mode is not None:
+            os.chmod(self.indexName(shard), self.mode)
+            os.chmod(os.path.join(self.dirname, dataName), self.mode)
+        if data:
+            data.close()
+        if self.dataNames[shard] is not None:
+            os.remove(os.path.join(self.dirname, self.dataNames[shard]))
+        del self.indexes[shard]
+        self.loadShard(shard)
 
+    def close(self):
+        self.sync()
+        with self.lock:
+            for data in self.maps.itervalues():
+                if data:
+                    data.close()
+            self.maps = {}
+            self.indexes = {}
+            self.cache = {}
+
+
+def dbopen(filename, flag=None, mode=None, format=None, journal=False):
+    return DictDB(filename, flag, mode, format, journal)
+
+def dbopen_sharded(dirname, flag=None, mode=None, shards=None):
+    return ShardedDictDB(dirname, flag, mode, shards)
+
+
+
+def benchmark(count=100000, dirname=None):
+    import tempfile, time
+    dirname = dirname or tempfile.mkdtemp()
+    items = dict(('key%08d' % idx, 'value %d ' % idx * 8) for idx in xrange(count))
+    print('%-16s %10s %10s %12s' % ('format', 'dump s', 'load s', 'bytes'))
+    for format in DictDB.FORMATS:
+        filename = os.path.join(dirname, 'bench.' + format)
+        db = dbopen(filename, 'n', format=format)
+        dict.update(db, items)
+        start = time.time()
+        db.sync()
+        dumpTime = time.time() - start
+        start = time.time()
+        loaded = dbopen(filename, 'r')
+        loadTime = time.time() - start
+        assert loaded == items
+        print('%-16s %10.3f %10.3f %12d' % (format, dumpTime, loadTime, os.path.getsize(filename)))
+    # files from before the header, found by trial and error
+    for format, writer in (('json', lambda file: json.dump(items, file, separators=(',', ':'))),
+                           ('csv', lambda file: csv.writer(file).writerows(items.iteritems()))):
+        filename = os.path.join(dirname, 'legacy.' + format)
+        file = __builtin__.open(filename, 'wb')
+        writer(file)
+        file.close()
+        start = time.time()
+        loaded = dbopen(filename, 'r')
+        assert loaded == items
+        print('%-16s %10s %10.3f %12d' % ('legacy ' + format, '', time.time() - start, os.path.getsize(filename)))
+    shutil.rmtree(dirname)
 
 if __name__ == '__main__':
-    import random
-    os.chdir('/dbm_sqlite/alt')
-    print(os.getcwd())
-    s = dbopen('tmp.shl', 'c', format='json')
-    print(s, 'start')
-    s['abc'] = '123'
-    s['rand'] = random.randrange(10000)
-    s.close()
-    f = __builtins__.open('tmp.shl', 'rb')
-    print (f.read())
-    f.close()
+    import sys
+    benchmark(*[int(arg) for arg in sys.argv[1:2]])
 ## end of http://code.activestate.com/recipes/576642/ }}}
\ No newline at end of file
@@ -0,0 +1,53 @@
+'''Memory benchmark for the core asset objects
+
+Compares the per-object overhead of the slotted core classes against
+dict-backed objects holding the same attributes (what every one of these
+objects used to be).  Attribute contents are shared between the two, so
+the numbers are the cost of the object itself.
+
+usage: python membench.py [count]
+'''
+
+import sys
+import base, task, tivo
+
+class DictBacked(object):
+	"""Stand-in for the pre-slots version of an object, holding the same attributes in a __dict__"""
+	def __init__(self, obj):
+		for cls in type(obj).__mro__:
+			for name in getattr(cls, '__slots__', ()):
+				if hasattr(obj, name):
+					setattr(self, name, getattr(obj, name))
+
+def objectSize(obj):
+	size = sys.getsizeof(obj)
+	if hasattr(obj, '__dict__'):
+		size += sys.getsizeof(obj.__dict__)
+	return size
+
+def measure(objs):
+	return sum([objectSize(obj) for obj in objs]) / float(len(objs))
+
+def benchmark(count):
+	server = tivo.TivoServer({'identity': 'bench'})
+	def videoAttr(idx):
+		return {'Details': {'Title': 'Show %d' % (idx % 500), 'ProgramId': 'EP%08d%04d' % (idx % 500, idx % 97 + 1)}, 'Links': {}}
+	cases = [
+		('AssetPlaceholder', lambda idx: base.AssetPlaceholder('TivoVideo', {'title': 'x'})),
+		('TivoVideo', lambda idx: tivo.TivoVideo(idx, server, videoAttr(idx))),
+		('Notification', lambda idx: task.Notification(None, task.Notification.ntNEWASSET, idx)),
+		('Progress', lambda idx: task.Progress(idx, count)),
+		('TransformSpec', lambda idx: base.TransformSpec()),
+	]
+	print '%-18s %12s %12s %8s' % ('class', 'dict bytes', 'slot bytes', 'saved')
+	for name, factory in cases:
+		objs = [factory(idx) for idx in xrange(count)]
+		after = measure(objs)
+		before = measure([DictBacked(obj) for obj in objs])
+		print '%-18s %12.1f %12.1f %7.1f%%' % (name, before, after, (before - after) * 100.0 / before)
+
+if __name__ == '__main__':
+	count = 10000
+	if len(sys.argv) > 1:
+		count = int(sys.argv[1])
+	benchmark(count)
@@ -4,6 +4,10 @@ import subprocess
 import errno
 import time
 import sys
+import threading
+import collections
+import Queue
+import stat
 
 PIPE = subprocess.PIPE
 
@@ -14,6 +18,7 @@ if subprocess.mswindows:
 else:
 	import select
 	import fcntl
+	import ctypes, ctypes.util
 
 class Popen(subprocess.Popen):
 	def recv(self, maxsize=None):
@@ -142,12 +147,426 @@ def recv_some(p, t=.1, e=1, tr=5, stderr=0):
 	return ''.join(y)
 	
 def send_all(p, data):
+	if not subprocess.mswindows:
+		return send_stream(p, data)
 	while len(data):
 		sent = p.send(data)
 		if sent is None:
 			raise Exception(message)
 		data = buffer(data, sent)
 
+if not subprocess.mswindows:
+	F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)		# linux only, and python 2 doesn't know it
+	PIPE_SIZE = 1024 * 1024			# what we'd like a child's stdin pipe to hold
+	SEND_BLOCK = 256 * 1024			# most we hand the kernel in one call
+	SPLICE_F_MOVE, SPLICE_F_MORE = 1, 4
+
+	def set_nonblocking(fd):
+		flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+		if not flags & os.O_NONBLOCK:
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+	# fewer, bigger writes: returns the pipe's new size, or None if it can't be changed
+	def enlarge_pipe(fd, size = PIPE_SIZE):
+		if not sys.platform.startswith('linux'):
+			return None
+		try:
+			return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+		except IOError:
+			pass
+		try:
+			# more than an unprivileged process may ask for, so settle for the most we can have
+			file = open('/proc/sys/fs/pipe-max-size')
+			try:
+				limit = int(file.read())
+			finally:
+				file.close()
+			return fcntl.fcntl(fd, F_SETPIPE_SZ, min(size, limit))
+		except (IOError, OSError, ValueError):
+			return None
+
+	# sleep until fd will take a write (only matters if it's non-blocking, say because a Multiplexer has it)
+	def wait_writable(fd):
+		while True:
+			try:
+				if hasattr(select, 'poll'):
+					poller = select.poll()
+					poller.register(fd, select.POLLOUT)
+					poller.poll()
+				else:
+					select.select([], [fd], [fd])
+				return
+			except (select.error, IOError, OSError), why:
+				if why.args[0] != errno.EINTR:
+					raise
+
+	_libc = []
+	def libc():
+		if not _libc:
+			try:
+				_libc.append(ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True))
+			except OSError:
+				_libc.append(None)
+		return _libc[0]
+
+	# move up to count bytes from offset in src_fd to dst_fd without them passing through user space,
+	# returns how many moved (0 at the end of src), or None if the kernel can't do it for these fds
+	def kernel_send(src_fd, dst_fd, offset, count):
+		lib = libc()
+		if lib is None:
+			return None
+		off = ctypes.c_longlong(offset)
+		for name in ('splice', 'sendfile'):
+			call = getattr(lib, name, None)
+			if call is None:
+				continue
+			call.restype = ctypes.c_ssize_t
+			if name == 'splice':
+				moved = call(src_fd, ctypes.byref(off), dst_fd, None, ctypes.c_size_t(count), SPLICE_F_MOVE | SPLICE_F_MORE)
+			else:
+				moved = call(dst_fd, src_fd, ctypes.byref(off), ctypes.c_size_t(count))
+			if moved >= 0:
+				return moved
+			err = ctypes.get_errno()
+			if err in (errno.EINVAL, errno.ENOSYS, errno.EBADF, getattr(errno, 'EOPNOTSUPP', errno.EINVAL)):
+				continue		# not for this pair of fds, try the next way
+			raise OSError(err, os.strerror(err))
+		return None
+
+	def _send_view(fd, view):
+		sent = 0
+		while sent < len(view):
+			try:
+				sent += os.write(fd, view[sent:sent + SEND_BLOCK])
+			except OSError, why:
+				if why[0] == errno.EAGAIN:
+					wait_writable(fd)
+				elif why[0] != errno.EINTR:
+					raise
+		return sent
+
+	def _send_file(fd, source, count):
+		sent = 0
+		try:
+			source_fd = source.fileno()
+			regular = stat.S_ISREG(os.fstat(source_fd).st_mode)
+		except (AttributeError, IOError, OSError, ValueError):
+			regular = False
+		if regular:
+			# the file object may have read ahead of where it says it is, so go by tell() not the fd's offset
+			start = source.tell()
+			while count is None or sent < count:
+				chunk = SEND_BLOCK
+				if count is not None:
+					chunk = min(chunk, count - sent)
+				try:
+					moved = kernel_send(source_fd, fd, start + sent, chunk)
+				except OSError, why:
+					if why[0] == errno.EAGAIN:
+						wait_writable(fd)
+						continue
+					if why[0] == errno.EINTR:
+						continue
+					raise
+				if moved is None:
+					break			# no kernel path, carry on in user space from here
+				if moved == 0:
+					source.seek(start + sent)
+					return sent
+				sent += moved
+			source.seek(start + sent)
+			if count is not None and sent >= count:
+				return sent
+		if hasattr(source, 'readinto'):
+			block = bytearray(SEND_BLOCK)
+			view = memoryview(block)
+			while count is None or sent < count:
+				want = SEND_BLOCK
+				if count is not None:
+					want = min(want, count - sent)
+				got = source.readinto(view[:want])
+				if not got:
+					break
+				sent += _send_view(fd, view[:got])
+		else:
+			while count is None or sent < count:
+				want = SEND_BLOCK
+				if count is not None:
+					want = min(want, count - sent)
+				data = source.read(want)
+				if not data:
+					break
+				sent += _send_view(fd, memoryview(data))
+		return sent
+
+	def send_stream(p, source, count = None):
+		"""Write all of source (or count bytes of it, if it's a file) into the child's stdin, blocking until
+		it's all gone.  source may be anything with the buffer interface, which is written without copying, or
+		a file object, which goes by splice()/sendfile() when it's a regular file and the kernel supports it."""
+		if not p.stdin:
+			raise Exception(message)
+		fd = p.stdin.fileno()
+		if not getattr(p, '_pipe_enlarged', False):
+			enlarge_pipe(fd)
+			p._pipe_enlarged = True
+		try:
+			if hasattr(source, 'read'):
+				return _send_file(fd, source, count)
+			try:
+				view = memoryview(source)
+			except TypeError:
+				view = memoryview(str(source))		# an old style buffer() object
+			return _send_view(fd, view)
+		except OSError, why:
+			if why[0] == errno.EPIPE:
+				p._close('stdin')
+				raise Exception(message)
+			raise
+
+	class _Poller(object):
+		"""The best readiness interface the platform has: epoll, then poll, then select"""
+		def __init__(self):
+			self.fds = {}		# fd -> (wantRead, wantWrite)
+			if hasattr(select, 'epoll'):
+				self.kind = 'epoll'
+				self.impl = select.epoll()
+			elif hasattr(select, 'poll'):
+				self.kind = 'poll'
+				self.impl = select.poll()
+			else:
+				self.kind = 'select'
+				self.impl = None
+
+		def mask(self, read, write):
+			if self.kind == 'epoll':
+				return (read and select.EPOLLIN) | (write and select.EPOLLOUT)
+			return (read and select.POLLIN) | (write and select.POLLOUT)
+
+		def set(self, fd, read, write):
+			if self.fds.get(fd) == (read, write):
+				return
+			if self.kind != 'select':
+				if fd in self.fds:
+					self.impl.modify(fd, self.mask(read, write))
+				else:
+					self.impl.register(fd, self.mask(read, write))
+			self.fds[fd] = (read, write)
+
+		def remove(self, fd):
+			if fd in self.fds:
+				del self.fds[fd]
+				if self.kind != 'select':
+					self.impl.unregister(fd)
+
+		# returns [(fd, readable, writable)], where hangups and errors count as readable so they get noticed
+		def poll(self, timeout):
+			if self.kind == 'select':
+				readers = [fd for fd, (read, write) in self.fds.iteritems() if read]
+				writers = [fd for fd, (read, write) in self.fds.iteritems() if write]
+				readable, writable, broken = select.select(readers, writers, readers + writers, timeout)
+				ready = {}
+				for fd in readable + broken:
+					ready[fd] = (True, False)
+				for fd in writable:
+					ready[fd] = (fd in ready, True)
+				return [(fd, read, write) for fd, (read, write) in ready.iteritems()]
+			if self.kind == 'epoll':
+				events = self.impl.poll(-1 if timeout is None else timeout)
+				readBits, writeBits = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR, select.EPOLLOUT
+			else:
+				events = self.impl.poll(None if timeout is None else timeout * 1000)
+				readBits, writeBits = select.POLLIN | select.POLLHUP | select.POLLERR | select.POLLNVAL, select.POLLOUT
+			return [(fd, bool(event & readBits), bool(event & writeBits)) for fd, event in events]
+
+		def close(self):
+			if self.kind == 'epoll':
+				self.impl.close()
+
+	class Multiplexer(object):
+		"""Watches the pipes of any number of Popen children from one thread.  Their fds are made non-blocking
+		once, when they're registered, and output is handed to onData(proc, which, data) as soon as it's read,
+		or put on self.queue as (proc, which, data) if there's no callback.  data is None when the pipe closes.
+		Input for a child's stdin is queued with write() and fed in as the pipe has room."""
+		READ_SIZE = 64 * 1024
+
+		def __init__(self):
+			self.poller = _Poller()
+			self.lock = threading.RLock()
+			self.pipes = {}				# fd -> (proc, which, callback)
+			self.outgoing = {}			# stdin fd -> deque of strings (or None to close once drained)
+			self.queue = Queue.Queue()
+			self.running = False
+			self.thread = None
+			self.wakeRead, self.wakeWrite = os.pipe()
+			set_nonblocking(self.wakeRead)
+			set_nonblocking(self.wakeWrite)
+			self.poller.set(self.wakeRead, True, False)
+
+		def register(self, proc, onData = None):
+			with self.lock:
+				for which in ('stdout', 'stderr'):
+					pipe = getattr(proc, which)
+					if pipe is not None:
+						set_nonblocking(pipe.fileno())
+						self.pipes[pipe.fileno()] = (proc, which, onData)
+						self.poller.set(pipe.fileno(), True, False)
+				if proc.stdin is not None:
+					set_nonblocking(proc.stdin.fileno())
+					self.pipes[proc.stdin.fileno()] = (proc, 'stdin', onData)
+					self.outgoing[proc.stdin.fileno()] = collections.deque()
+			self.wake()
+
+		def unregister(self, proc):
+			with self.lock:
+				for fd, (other, which, onData) in self.pipes.items():
+					if other is proc:
+						self.forget(fd)
+
+		def forget(self, fd):
+			self.poller.remove(fd)
+			self.pipes.pop(fd, None)
+			self.outgoing.pop(fd, None)
+
+		# queue data for the child's stdin, data may be anything supporting the buffer interface
+		def write(self, proc, data):
+			with self.lock:
+				if proc.stdin is None or proc.stdin.fileno() not in self.outgoing:
+					raise Exception(message)
+				fd = proc.stdin.fileno()
+				self.outgoing[fd].append(data)
+				self.poller.set(fd, False, True)
+			self.wake()
+
+		# close the child's stdin once everything queued for it has been written
+		def closeStdin(self, proc):
+			with self.lock:
+				if proc.stdin is not None and proc.stdin.fileno() in self.outgoing:
+					fd = proc.stdin.fileno()
+					self.outgoing[fd].append(None)
+					self.poller.set(fd, False, True)
+			self.wake()
+
+		def wake(self):
+			if self.thread is not None and threading.current_thread() is not self.thread:
+				try:
+					os.write(self.wakeWrite, 'x')
+				except OSError, why:
+					if why[0] != errno.EAGAIN:		# full means a wakeup is already on its way
+						raise
+
+		def start(self):
+			if self.thread is None:
+				self.running = True
+				self.thread = threading.Thread(target=self.run, name='pipe multiplexer')
+				self.thread.daemon = True
+				self.thread.start()
+
+		def stop(self):
+			self.running = False
+			self.wake()
+			if self.thread is not None and threading.current_thread() is not self.thread:
+				self.thread.join()
+			self.thread = None
+
+		def close(self):
+			self.stop()
+			self.poller.close()
+			os.close(self.wakeRead)
+			os.close(self.wakeWrite)
+
+		def run(self):
+			while self.running:
+				self.poll(None)
+
+		# wait up to timeout for something to happen and deal with it, for callers running their own loop
+		def poll(self, timeout = None):
+			try:
+				events = self.poller.poll(timeout)
+			except (IOError, OSError, select.error), why:
+				if why.args[0] == errno.EINTR:
+					return
+				raise
+			for fd, readable, writable in events:
+				if fd == self.wakeRead:
+					self.drainWakeups()
+					continue
+				with self.lock:
+					entry = self.pipes.get(fd)
+				if entry is None:
+					continue
+				if writable:
+					self.pump(fd, entry)
+				elif readable:
+					self.read(fd, entry)
+
+		def drainWakeups(self):
+			try:
+				while os.read(self.wakeRead, 4096):
+					pass
+			except OSError, why:
+				if why[0] != errno.EAGAIN:
+					raise
+
+		def deliver(self, entry, data):
+			proc, which, onData = entry
+			if onData is not None:
+				onData(proc, which, data)
+			else:
+				self.queue.put((proc, which, data))
+
+		def read(self, fd, entry):
+			proc, which, onData = entry
+			if which == 'stdin':
+				self.closed(fd, entry)		# a hangup on stdin, the child isn't reading any more
+				return
+			try:
+				data = os.read(fd, self.READ_SIZE)
+			except OSError, why:
+				if why[0] == errno.EAGAIN:
+					return
+				data = ''
+			if not data:
+				self.closed(fd, entry)
+				return
+			if proc.universal_newlines:
+				data = proc._translate_newlines(data)
+			self.deliver(entry, data)
+
+		def pump(self, fd, entry):
+			with self.lock:
+				pending = self.outgoing.get(fd)
+				while pending:
+					data = pending[0]
+					if data is None:
+						self.closed(fd, entry)
+						return
+					try:
+						written = os.write(fd, data)
+					except OSError, why:
+						if why[0] == errno.EAGAIN:
+							return
+						if why[0] == errno.EPIPE:
+							self.closed(fd, entry)
+							return
+						raise
+					if written < len(data):
+						try:
+							pending[0] = memoryview(data)[written:]
+						except TypeError:
+							pending[0] = buffer(data, written)
+						return
+					pending.popleft()
+				if pending is not None:
+					self.poller.set(fd, False, False)
+
+		def closed(self, fd, entry):
+			proc, which, onData = entry
+			with self.lock:
+				self.forget(fd)
+				if getattr(proc, which) is not None:
+					proc._close(which)
+			self.deliver(entry, None)
+
 if __name__ == '__main__':
 	if sys.platform == 'win32':
 		shell, commands, tail = ('cmd', ('dir /w', 'echo HELLO WORLD'), '\r\n')
@@ -162,4 +581,22 @@ if __name__ == '__main__':
 	send_all(a, 'exit' + tail)
 	print recv_some(a, e=0)
 	a.wait()
+
+	if not subprocess.mswindows:
+		# the same conversation, through a multiplexer
+		mux = Multiplexer()
+		mux.start()
+		a = Popen(shell, stdin=PIPE, stdout=PIPE)
+		mux.register(a)
+		for cmd in commands + ('exit',):
+			mux.write(a, cmd + tail)
+		mux.closeStdin(a)
+		while True:
+			proc, which, data = mux.queue.get()
+			if data is None and which == 'stdout':
+				break
+			if data is not None:
+				print data,
+		a.wait()
+		mux.close()
 ## end of http://code.activestate.com/recipes/440554/ }}}
\ No newline at end of file
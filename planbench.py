@@ -0,0 +1,54 @@
+'''Planner benchmark for Goal.findChain
+
+Registers a synthetic pipeline of stages, each with several alternative
+transforms, and times the serial planner against the process pool
+planner on it, checking that both come back with the same library.
+
+usage: python planbench.py [variants] [stages] [processes]
+'''
+
+import sys, time
+import base, task
+
+class StageTransform(base.Transform):
+	def __init__(self, stage, variant):
+		base.Transform.__init__(self)
+		self.stage = stage
+		self.variant = variant
+		key = base.TransformPlaceholder()
+		self.SPEC = base.TransformSpec()
+		if stage > 0:
+			self.SPEC.requires = [base.AssetPlaceholder('Stage%d' % stage, {'key': key})]
+		self.SPEC.produces = [base.AssetPlaceholder('Stage%d' % (stage + 1), {'key': key})]
+	def spec(self):
+		return self.SPEC
+	def __repr__(self):
+		return '<Stage %d/%d>' % (self.stage, self.variant)
+
+def register(variants, stages):
+	for stage in range(stages):
+		for variant in range(variants):
+			task.avail_transforms.add(StageTransform(stage, variant))
+
+def benchmark(variants, stages, processes):
+	register(variants, stages)
+	goal = task.Goal(base.AssetPlaceholder('Stage%d' % stages, {}))
+
+	start = time.time()
+	serial = goal.findChain()
+	serialTime = time.time() - start
+
+	start = time.time()
+	parallel = goal.findChain(processes=processes)
+	parallelTime = time.time() - start
+
+	print '%d transforms, %d specs in library' % (len(task.avail_transforms), len(serial))
+	print 'serial:   %.2fs' % serialTime
+	print 'parallel: %.2fs (%d processes, %.2fx)' % (parallelTime, processes, serialTime / parallelTime)
+	if serial != parallel:
+		print 'MISMATCH: parallel planner found a different library'
+
+if __name__ == '__main__':
+	args = [int(arg) for arg in sys.argv[1:]]
+	variants, stages, processes = (args + [6, 5, 4][len(args):])[:3]
+	benchmark(variants, stages, processes)
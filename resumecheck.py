@@ -0,0 +1,134 @@
+'''Resumable download check
+
+Serves a file from a local BaseHTTPServer standing in for a TiVo, one
+that honours Range requests and can be told to cut the connection part
+way through the body, and downloads it with the threaded and event loop
+download tasks:
+
+  - through several forced disconnects within one task
+  - in a second task, after the first gives up part way
+  - past a partial file left by some other recording
+  - from a server that ignores Range (200 instead of 206)
+  - when the checkpoint already covers the whole file (416)
+
+Each one meant to finish must leave a byte-identical file and no .part.
+
+usage: python resumecheck.py [megabytes]
+'''
+
+import sys, os, json, shutil, tempfile, threading, time, BaseHTTPServer
+import task, tivo
+
+class StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves server.data, cutting the body short for the next server.drops requests"""
+	def log_message(self, *args):
+		pass
+	def do_GET(self):
+		server = self.server
+		data = server.data
+		rangeHeader = self.headers.getheader('Range')
+		server.ranges.append(rangeHeader)
+		start = 0
+		if rangeHeader and server.honourRange:
+			start = int(rangeHeader[len('bytes='):].rstrip('-'))
+			if start >= len(data):
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */%d' % len(data))
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+		else:
+			self.send_response(200)
+		self.send_header('Content-Length', str(len(data) - start))
+		self.end_headers()
+		body = data[start:]
+		if server.drops > 0:
+			server.drops -= 1
+			body = body[:len(body) / 3]
+		self.wfile.write(body)
+
+class StandInVideo(object):
+	def __init__(self, url, size):
+		self.server = self
+		self.mediaKey = '0123456789'
+		self.details = {'Title': 'Check', 'SourceSize': size}
+		self.links = {'Content': {'Url': url}}
+
+def download(cls, filename, video):
+	tasks = task.TaskController()
+	stdout, stderr = sys.stdout, sys.stderr
+	sys.stdout = sys.stderr = open(os.devnull, 'w')		# the tasks are chatty, and the failures meant to happen print tracebacks
+	try:
+		download = cls(None, tivo.TivoVideoDownload(filename, video.mediaKey), video, tivo.TivoServerQuery(video.mediaKey), task.ObservableEnvironment())
+		tasks.addTask(download)
+		start = time.time()
+		while download.status not in task.Task.FINISHED and time.time() - start < 60:
+			tasks.handleMessages(True, 0.1)
+	finally:
+		tasks.stop()
+		sys.stdout.close()
+		sys.stdout, sys.stderr = stdout, stderr
+	return download.status
+
+def check(megabytes):
+	tivo.TivoDownload.RETRY_DELAY = 0
+	tivo.TivoDownload.CHECKPOINT_INTERVAL = 256 * 1024
+	server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandIn)
+	server.data = os.urandom(megabytes * 1024 * 1024 + 123)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	video = StandInVideo('http://127.0.0.1:%d/download/check.TiVo?id=1' % server.server_port, len(server.data))
+	tempDir = tempfile.mkdtemp(prefix='resumecheck')
+	filename = os.path.join(tempDir, 'check.tivo')
+	failed = 0
+
+	def case(label, cls, status = task.Task.tsCOMPLETE, drops = 0, honourRange = True, retries = 5):
+		server.drops = drops
+		server.honourRange = honourRange
+		server.ranges = []
+		tivo.TivoDownload.RETRIES = retries
+		got = download(cls, filename, video)
+		if status == task.Task.tsCOMPLETE:
+			ok = open(filename, 'rb').read() == server.data and not os.path.exists(filename + '.part')
+		else:
+			ok = os.path.exists(filename + '.part')
+		ok = ok and got == status
+		print '%-34s %-9s %s %s' % (label, task.Task.STATUS_STRING[got], ok and 'ok' or 'FAILED', server.ranges)
+		return not ok
+	def clear():
+		for name in (filename, filename + '.part'):
+			if os.path.exists(name):
+				os.remove(name)
+
+	try:
+		for cls in (tivo.TivoDownloadTask, tivo.TivoDownloadAsyncTask):
+			clear()
+			failed += case('%s, 3 drops' % cls.__name__, cls, drops = 3)
+		clear()
+		failed += case('gives up after a drop', tivo.TivoDownloadTask, task.Task.tsFAILED, drops = 1, retries = 0)
+		failed += case('next task resumes', tivo.TivoDownloadTask)
+
+		clear()
+		open(filename, 'wb').write('not this one' * 1000)
+		json.dump({'source': '/download/other.TiVo?id=2', 'offset': 12000}, open(filename + '.part', 'w'))
+		failed += case('partial of another recording', tivo.TivoDownloadTask)
+
+		clear()
+		failed += case('give up again', tivo.TivoDownloadTask, task.Task.tsFAILED, drops = 1, retries = 0)
+		failed += case('server ignores Range', tivo.TivoDownloadTask, honourRange = False)
+
+		json.dump({'source': '/download/check.TiVo?id=1', 'offset': len(server.data)}, open(filename + '.part', 'w'))
+		failed += case('checkpoint already complete (416)', tivo.TivoDownloadTask)
+	finally:
+		server.shutdown()
+		shutil.rmtree(tempDir)
+	return failed
+
+if __name__ == '__main__':
+	megabytes = 4
+	if len(sys.argv) > 1:
+		megabytes = int(sys.argv[1])
+	sys.exit(check(megabytes) and 1 or 0)
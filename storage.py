@@ -0,0 +1,144 @@
+'''Where downloads are written
+
+A StoragePool spreads new files over a set of volumes (directories,
+ideally on separate disks).  Each goes on whichever volume has the fewest
+files being written to it and then the most room, and a file no volume
+has room for is refused until one does.  preallocate() asks the
+filesystem for a file's blocks up front, so concurrent downloads to one
+disk don't interleave theirs.
+'''
+
+import os, sys, errno, threading, ctypes, time
+import pipesubproc
+
+FALLOC_FL_KEEP_SIZE = 1		# allocate without changing the file's size, so appending and resuming work as before
+
+# reserve blocks for length bytes from offset in f; False if the filesystem (or platform) can't
+def preallocate(f, offset, length):
+	if length <= 0 or not hasattr(pipesubproc, 'libc'):
+		return False
+	lib = pipesubproc.libc()
+	call = lib and (getattr(lib, 'fallocate64', None) or getattr(lib, 'fallocate', None))
+	if call is None:
+		return False
+	call.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+	if call(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+		return True
+	err = ctypes.get_errno()
+	if err == errno.ENOSPC:
+		raise IOError(err, os.strerror(err))
+	return False
+
+# bytes the filesystem has given filename so far, preallocated blocks included
+def allocated(filename):
+	try:
+		st = os.stat(filename)
+	except OSError:
+		return 0
+	if hasattr(st, 'st_blocks'):
+		return st.st_blocks * 512
+	return st.st_size
+
+def freeSpace(path):
+	if hasattr(os, 'statvfs'):
+		st = os.statvfs(path)
+		return st.f_bavail * st.f_frsize
+	free = ctypes.c_ulonglong(0)
+	ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), ctypes.byref(free), None, None)
+	return free.value
+
+class Volume(object):
+	ROOM_TTL = 1.0			# seconds to trust a measurement of available(), which is asked on every scheduling pass
+
+	def __init__(self, path, margin):
+		self.path = path
+		self.margin = margin			# bytes to leave free
+		self.placements = set()			# files being written here
+		self.room = None
+		self.measuredAt = None
+	def filename(self, name):
+		return os.path.join(self.path, name)
+	# room for more files, after what's promised to the ones being written
+	def available(self):
+		now = time.time()
+		if self.measuredAt is None or now - self.measuredAt > self.ROOM_TTL:
+			promised = sum([placement.outstanding() for placement in self.placements])
+			self.room = freeSpace(self.path) - self.margin - promised
+			self.measuredAt = now
+		return self.room
+	def add(self, placement):
+		self.placements.add(placement)
+		if self.room is not None:
+			self.room -= placement.outstanding()		# keep the measurement honest until it's next taken
+	def discard(self, placement):
+		if placement in self.placements:
+			self.placements.discard(placement)
+			self.measuredAt = None
+	def __repr__(self):
+		return "<Volume %s: %d writing>" % (self.path, len(self.placements))
+
+class Placement(object):
+	"""Room on a volume for one file of size bytes, held until it's released"""
+	def __init__(self, pool, volume, filename, size):
+		self.pool = pool
+		self.volume = volume		# None for a file outside the pool's volumes
+		self.filename = filename
+		self.size = size
+	# what's promised but not yet allocated
+	def outstanding(self):
+		return max(0, self.size - allocated(self.filename))
+	def release(self):
+		self.pool.release(self)
+
+class StoragePool(object):
+	MARGIN = 1024**3
+
+	def __init__(self, paths, margin = MARGIN):
+		self.volumes = [Volume(os.path.abspath(path), margin) for path in paths]
+		self.lock = threading.Lock()
+
+	# where name already is, if it's on any of our volumes
+	def find(self, name):
+		for volume in self.volumes:
+			if os.path.isfile(volume.filename(name)):
+				return volume.filename(name)
+		return None
+	def volumeOf(self, filename):
+		filename = os.path.abspath(filename)
+		for volume in self.volumes:
+			if filename.startswith(os.path.join(volume.path, '')):
+				return volume
+		return None
+
+	# a Placement for a new file called name of (about) size bytes, or None if no volume has room.  A volume that
+	# already has some of it (from an interrupted download, say) gets it again if there's room for the rest.
+	def place(self, name, size):
+		with self.lock:
+			for volume in self.volumes:
+				filename = volume.filename(name)
+				if os.path.isfile(filename) and volume.available() >= size - allocated(filename):
+					return self.add(volume, filename, size)
+			best = None
+			for volume in self.volumes:
+				room = volume.available()
+				if room >= size and (best is None or (len(volume.placements), -room) < best[0]):
+					best = ((len(volume.placements), -room), volume)
+			if best is None:
+				return None
+			return self.add(best[1], best[1].filename(name), size)
+	# a Placement for a file whose path is already decided, or None if its volume hasn't room
+	def reserve(self, filename, size):
+		with self.lock:
+			volume = self.volumeOf(filename)
+			if volume is not None and volume.available() < size - allocated(filename):
+				return None
+			return self.add(volume, filename, size)
+	def add(self, volume, filename, size):
+		placement = Placement(self, volume, filename, size)
+		if volume is not None:
+			volume.add(placement)
+		return placement
+	def release(self, placement):
+		with self.lock:
+			if placement.volume is not None:
+				placement.volume.discard(placement)
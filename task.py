@@ -1,10 +1,151 @@
-import threading, Queue, base, copy
+import threading, Queue, base, copy, hashlib, cPickle, cStringIO, heapq, itertools, time, multiprocessing, collections
+import socket, select, errno, sys, traceback, os, shutil, math
+import dbdict, pipesubproc
 from base import Environment
 
+class TransformRegistry(object):
+	"""The set of transforms available to the planner, indexed by the assets they produce"""
+	def __init__(self, transforms = None):
+		self.specs = {}				# transform -> spec (computed once at registration)
+		self.byType = {}			# asset type -> set of (spec, product)
+		self.byBinding = {}			# (asset type, attr) -> set of (spec, product) that bind attr to a value
+		self.byValue = {}			# (asset type, attr, value) -> set of (spec, product)
+		self.keys = {}				# transform -> name that identifies it across processes
+		self.byKey = {}				# name -> transform
+		self.fingerprintCache = None
+		if transforms is not None:
+			for transform in transforms:
+				self.add(transform)
+	def __iter__(self):
+		return iter(self.specs)
+	def __len__(self):
+		return len(self.specs)
+	def __contains__(self, transform):
+		return transform in self.specs
+
+	def add(self, transform):
+		if transform in self.specs:
+			return
+		spec = transform.spec()
+		assert(spec is not None)
+		if spec.transforms is None:
+			spec.transforms = tuple([ transform ])
+		self.specs[transform] = spec
+		key = '%s.%s' % (transform.__class__.__module__, transform.__class__.__name__)
+		if key in self.byKey:
+			idx = 2
+			while '%s#%d' % (key, idx) in self.byKey:
+				idx += 1
+			key = '%s#%d' % (key, idx)
+		self.keys[transform] = key
+		self.byKey[key] = transform
+		self.fingerprintCache = None
+		if spec.produces is not None:
+			for product in spec.produces:
+				entry = (spec, product)
+				self.byType.setdefault(product.type, set()).add(entry)
+				for attr in product.attr:
+					value = product.attr[attr]
+					if not isinstance(value, base.TransformPlaceholder):
+						self.byBinding.setdefault((product.type, attr), set()).add(entry)
+						self.byValue.setdefault((product.type, attr, value), set()).add(entry)
+
+	def remove(self, transform):
+		spec = self.specs.pop(transform)
+		del self.byKey[self.keys.pop(transform)]
+		self.fingerprintCache = None
+		if spec.produces is not None:
+			for product in spec.produces:
+				entry = (spec, product)
+				self.__unindex(self.byType, product.type, entry)
+				for attr in product.attr:
+					value = product.attr[attr]
+					if not isinstance(value, base.TransformPlaceholder):
+						self.__unindex(self.byBinding, (product.type, attr), entry)
+						self.__unindex(self.byValue, (product.type, attr, value), entry)
+	def discard(self, transform):
+		if transform in self.specs:
+			self.remove(transform)
+	def __unindex(self, index, key, entry):
+		entries = index[key]
+		entries.discard(entry)
+		if not entries:
+			del index[key]
+
+	def spec(self, transform):
+		return self.specs[transform]
+	def keyOf(self, transform):
+		return self.keys.get(transform)
+	def transformOf(self, key):
+		return self.byKey[key]
+
+	# pickle an object graph, referring to any registered transforms by name so that loads() (in this
+	# or another process with the same registrations) hands back the live instances
+	def dumps(self, obj):
+		file = cStringIO.StringIO()
+		pickler = cPickle.Pickler(file, cPickle.HIGHEST_PROTOCOL)
+		pickler.persistent_id = self.__persistentId
+		pickler.dump(obj)
+		return file.getvalue()
+	def loads(self, data):
+		unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+		unpickler.persistent_load = self.transformOf
+		return unpickler.load()
+	def __persistentId(self, obj):
+		if isinstance(obj, base.Transform):
+			return self.keyOf(obj)
+		return None
+
+	# a digest of everything registered, changes whenever the set of transforms (or their specs) do
+	def fingerprint(self):
+		if self.fingerprintCache is None:
+			desc = sorted([(self.keys[transform], self.specs[transform].shape()) for transform in self.specs])
+			self.fingerprintCache = hashlib.sha1(repr(desc)).hexdigest()
+		return self.fingerprintCache
+
+	# which (spec, product) pairs could possibly produce the specified asset?
+	def candidates(self, phAsset):
+		entries = self.byType.get(phAsset.type)
+		if not entries:
+			return frozenset()
+		for attr in phAsset.attr:
+			value = phAsset.attr[attr]
+			if isinstance(value, base.TransformPlaceholder):
+				continue
+			# a product that binds this attribute to some other value can never match
+			binding = self.byBinding.get((phAsset.type, attr))
+			if binding:
+				entries = entries - (binding - self.byValue.get((phAsset.type, attr, value), frozenset()))
+		return entries
+
+	# which specs can produce the specified asset?  Weak matches are returned as copies carrying
+	# the attributes the product doesn't mention in their extras
+	def producersOf(self, phAsset, isWeak = True):
+		strong = set()
+		weak = {}
+		for spec, product in self.candidates(phAsset):
+			if spec in strong:
+				continue
+			if product.satisfies(phAsset):
+				strong.add(spec)
+				weak.pop(spec, None)
+			elif isWeak and spec not in weak and isinstance(phAsset, base.AssetPlaceholder):
+				extras = phAsset.weaklySatisfiedBy(product)
+				if extras is not None:
+					weak[spec] = extras
+		specs = set(strong)
+		for spec in weak:
+			extras = dict(spec.extras or {})
+			extras.update(weak[spec])
+			newSpec = copy.copy(spec)
+			newSpec.extras = base.FrozenDict(extras)
+			specs.add(newSpec)
+		return specs
+
 try:
     avail_transforms
 except NameError:
-    avail_transforms = set()
+    avail_transforms = TransformRegistry()
 
 ###############################################################################
 
@@ -17,6 +158,7 @@ class Observable(set):
 			observer(self, arg)
 
 class Notification(object):
+	__slots__ = ('task', 'type', 'value')
 	ntSTATUS, ntPROGRESS, ntNEWASSET, ntDEADASSET, ntDELAYNOTIFY = range(5)
 	TYPE_STRING = { ntSTATUS:'status', ntPROGRESS:'progress', ntNEWASSET:'new asset', ntDEADASSET:'dead asset', ntDELAYNOTIFY:'delayed notification' }
 	
@@ -26,34 +168,148 @@ class Notification(object):
 		self.value = value
 	def __repr__(self):
 		return "<Notification %s: %s %s>" % (repr(self.task), Notification.TYPE_STRING[self.type], repr(self.value))
+
+	# only the most recent status or progress of a task is worth delivering
+	@staticmethod
+	def coalesceKey(msg):
+		if msg.type == Notification.ntSTATUS or msg.type == Notification.ntPROGRESS:
+			return (msg.task, msg.type)
+		return None
 		
 class MessageQueue(object):
-	def __init__(self):
-		self.queue = Queue.Queue()
+	ovBLOCK, ovDROPNEWEST, ovDROPOLDEST, ovRAISE = range(4)
+	OVERFLOW_STRING = { ovBLOCK:'block', ovDROPNEWEST:'drop newest', ovDROPOLDEST:'drop oldest', ovRAISE:'raise' }
+
+	DEAD = object()		# what's left in the queue of a message that was replaced
+
+	def __init__(self, maxsize = 0, overflow = ovBLOCK, coalesce = None):
+		self.maxsize = maxsize			# 0 for unbounded
+		self.overflow = overflow		# what enqueue does when the queue is full
+		self.coalesce = coalesce		# msg -> key (or None); a new message replaces a pending one with the same key
+		self.queue = collections.deque()	# of [key, msg]
+		self.count = 0					# messages in queue that haven't been replaced
+		self.pending = {}				# key -> entry in queue
+		self.dropped = 0
+		self.handler = None				# the thread dispatching messages, which never blocks on a full queue
+		self.lock = threading.Lock()
+		self.notEmpty = threading.Condition(self.lock)
+		self.notFull = threading.Condition(self.lock)
+
 	def enqueue(self, obj):
-		self.queue.put(obj)
+		key = None
+		if self.coalesce is not None:
+			key = self.coalesce(obj)
+		with self.lock:
+			if key is not None and key in self.pending:
+				old = self.pending[key]
+				if self.queue[-1] is old:
+					old[1] = obj
+					return
+				# the replacement goes to the back, so it's never delivered ahead of anything queued since the one it replaces
+				old[1] = MessageQueue.DEAD
+				entry = [key, obj]
+				self.queue.append(entry)
+				self.pending[key] = entry
+				if len(self.queue) > 2 * self.count + 16:
+					self.queue = collections.deque([entry for entry in self.queue if entry[1] is not MessageQueue.DEAD])
+				return
+			if self.maxsize > 0 and self.count >= self.maxsize:
+				if self.overflow == MessageQueue.ovBLOCK:
+					# if the dispatcher itself is posting, waiting for it to drain would never end
+					while self.count >= self.maxsize and self.handler is not threading.current_thread():
+						self.notFull.wait()
+				elif self.overflow == MessageQueue.ovDROPNEWEST:
+					self.dropped += 1
+					return
+				elif self.overflow == MessageQueue.ovDROPOLDEST:
+					self.dropped += 1
+					self.__popEntry()
+				else:
+					raise Queue.Full
+			entry = [key, obj]
+			self.queue.append(entry)
+			self.count += 1
+			if key is not None:
+				self.pending[key] = entry
+			self.notEmpty.notify()
+
+	def __popEntry(self):
+		while True:
+			key, obj = self.queue.popleft()
+			if obj is not MessageQueue.DEAD:
+				break
+		self.count -= 1
+		if key is not None:
+			del self.pending[key]
+		return obj
+
 	def empty(self):
-		return self.queue.empty()
+		with self.lock:
+			return not self.count
+	def __len__(self):
+		with self.lock:
+			return self.count
 	def dequeue(self):
+		batch = self.dequeueBatch(1)
+		if batch:
+			return batch[0]
+		return None
+
+	# remove up to maxBatch messages (all of them if None), waiting for at least one if block is set
+	def dequeueBatch(self, maxBatch = None, block = False, timeout = None):
+		with self.lock:
+			if block:
+				deadline = None
+				if timeout is not None:
+					deadline = time.time() + timeout
+				while not self.count:
+					if deadline is None:
+						self.notEmpty.wait()
+					else:
+						remaining = deadline - time.time()
+						if remaining <= 0:
+							break
+						self.notEmpty.wait(remaining)
+			batch = []
+			while self.count and (maxBatch is None or len(batch) < maxBatch):
+				batch.append(self.__popEntry())
+			if batch:
+				self.notFull.notify_all()
+			return batch
+
+	# dispatch messages a batch (a list) at a time until the queue is empty (or stays empty for timeout if block is set)
+	def handleBatch(self, dispatch, args=None, block=False, timeout=None, maxBatch=None):
+		prevHandler = self.handler
+		self.handler = threading.current_thread()
 		try:
-			return self.queue.get_nowait()
-		except Queue.Empty:
-			return None
-	def handle(self, dispatch, args=None, block=False, timeout=None):
-		while True:
-			try:
+			while True:
+				batch = self.dequeueBatch(maxBatch, block, timeout)
+				if not batch:
+					return
 				thisArg = []
 				if args is not None:
 					thisArg = list(args)
-				thisArg.append(self.queue.get(block, timeout))
-			except Queue.Empty:
-				return
-			dispatch(*thisArg)
+				thisArg.append(batch)
+				dispatch(*thisArg)
+		finally:
+			self.handler = prevHandler
+
+	def handle(self, dispatch, args=None, block=False, timeout=None):
+		def dispatchEach(*thisArg):
+			for msg in thisArg[-1]:
+				dispatch(*(thisArg[:-1] + (msg,)))
+		self.handleBatch(dispatchEach, args, block, timeout)
 
 class Progress(object):
-	def __init__(self, pos, max):
+	__slots__ = ('pos', 'max', 'rate', 'avgRate', 'eta')
+	def __init__(self, pos, max, rate = None, avgRate = None, eta = None):
 		self.pos = pos
-		self.max = max
+		self.max = max				# 0 when we don't know
+		self.rate = rate			# per second, over the last interval
+		self.avgRate = avgRate		# per second, smoothed over a few intervals
+		self.eta = eta				# seconds to go at avgRate
+	def __repr__(self):
+		return "<Progress %d/%d>" % (self.pos, self.max)
 	
 class ObservableEnvironment(Environment):
 	def __init__(self):
@@ -69,6 +325,7 @@ class ObservableEnvironment(Environment):
 		Environment.declareAsset(self, obj)
 		if isNew:
 			self.observers.notifyObservers(Notification(self, Notification.ntNEWASSET, obj))
+		return obj
 
 	def undeclareAsset(self, obj):
 		isDead = (obj.type in self.assetsByType) and (obj in self.assetsByType[obj.type])
@@ -79,11 +336,22 @@ class ObservableEnvironment(Environment):
 class Task(object):
 	tsQUEUED, tsRUNNING, tsCOMPLETE, tsCANCELLED, tsFAILED = range(5)
 	STATUS_STRING = { tsQUEUED:'queued', tsRUNNING:'running', tsCOMPLETE:'complete', tsCANCELLED:'cancelled', tsFAILED:'failed' }
+	FINISHED = frozenset([tsCOMPLETE, tsCANCELLED, tsFAILED])
+	SLOTS = {}			# global slots (e.g. 'cpu', 'net') this task occupies while it runs
+	PROGRESS_INTERVAL = 0.5		# seconds between progress notifications
+	RATE_SMOOTHING = 5.0		# seconds, the time constant of avgRate
 
 	def __init__(self):
 		self.status = Task.tsQUEUED
 		self.progress = Progress(0,0)
+		self.progressAt = None
 		self.observers = Observable()
+		self.consumes = ()
+		self.locks = ()
+		self.priority = 0				# higher runs sooner
+		self.deadline = None			# time.time() we'd like it done by, None for whenever
+		self.queuedAt = None
+		self.queueSeq = None
 	def addObserver(self, obj):
 		self.observers.add(obj)
 	def removeObserver(self, obj):
@@ -101,6 +369,49 @@ class Task(object):
 	def statusChanged(self, newStatus):
 		self.status = newStatus
 		self.observers.notifyObservers(Notification(self, Notification.ntSTATUS, newStatus))
+	# call as often as you like, observers hear at most every PROGRESS_INTERVAL unless it's forced (at the start and end, say)
+	def progressChanged(self, pos, total = None, force = False):
+		now = time.time()
+		if not force and self.progressAt is not None and now - self.progressAt < self.PROGRESS_INTERVAL:
+			return
+		last = self.progress
+		if total is None:
+			total = last.max
+		rate = last.rate
+		avgRate = last.avgRate
+		# a forced update hard on the heels of the last one is too short an interval to measure anything over
+		if self.progressAt is not None and now > self.progressAt and (pos != last.pos or now - self.progressAt >= self.PROGRESS_INTERVAL):
+			elapsed = now - self.progressAt
+			rate = (pos - last.pos) / elapsed
+			if avgRate is None:
+				avgRate = rate
+			else:
+				avgRate += (1 - math.exp(-elapsed / self.RATE_SMOOTHING)) * (rate - avgRate)
+		eta = None
+		if total and avgRate:
+			eta = max(0, total - pos) / avgRate
+		self.progressAt = now
+		self.progress = Progress(pos, total, rate, avgRate, eta)		# a new one each time, observers may be on another thread
+		self.observers.notifyObservers(Notification(self, Notification.ntPROGRESS, self.progress))
+
+	# pick out the assets of instance that sit in the consumes and locks positions of spec
+	def claim(self, spec, instance):
+		start = len(spec.requires or ())
+		end = start + len(spec.consumes or ())
+		self.consumes = tuple(instance[start:end])
+		self.locks = tuple(instance[end:end + len(spec.locks or ())])
+	def resources(self):
+		return self.consumes + self.locks
+	def slots(self):
+		return self.SLOTS
+	# rough size of the job (bytes to move, say) so the scheduler can put short jobs ahead of long ones
+	def cost(self):
+		return 0
+	# take whatever the task needs from outside the controller (disk space, say) as it's admitted; False keeps it queued
+	def reserve(self):
+		return True
+	def unreserve(self):
+		pass
 
 class ThreadTask(Task):
 	thrSTOPPED, thrSTARTING, thrRUNNING, thrSTOPPING, thrCANCELLING = range(5)
@@ -138,39 +449,579 @@ class ThreadTask(Task):
 			self.threadStatus = ThreadTask.thrSTOPPING
 	def run(self):
 		pass
+	def active(self):
+		return self.threadStatus == ThreadTask.thrRUNNING
 	def __repr__(self):
 		return "<ThreadTask: %s>" % self.name()
-		
+
+def wakeupPair():
+	if hasattr(socket, 'socketpair'):
+		return socket.socketpair()
+	# no socketpair on windows, so do it the long way around
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	try:
+		listener.bind(('127.0.0.1', 0))
+		listener.listen(1)
+		client = socket.create_connection(listener.getsockname())
+		server, addr = listener.accept()
+	finally:
+		listener.close()
+	return server, client
+
+class IoLoop(object):
+	"""Drives AsyncTasks: one thread waits on all of their sockets and timers with select(), and a bounded pool
+	of worker threads takes the calls that can only be made blocking (urllib2's, which is all of HTTP here).  A
+	call holds its worker until it returns, so for those this is a thread pool, one thread per call in flight,
+	and the pool should be at least as big as the number of tasks that may be blocked at once."""
+	def __init__(self, workers = 4):
+		self.readers = {}			# socket or fd -> callback
+		self.writers = {}			# socket or fd -> callback
+		self.timers = []			# heap of [when, seq, callback, args]
+		self.order = itertools.count()
+		self.calls = collections.deque()	# (callback, args) posted from any thread
+		self.workers = workers
+		self.work = Queue.Queue()
+		self.running = False
+		self.thread = None
+		self.wakeRecv, self.wakeSend = wakeupPair()
+		self.wakeRecv.setblocking(0)
+
+	def start(self):
+		if self.thread is None:
+			self.running = True
+			self.thread = threading.Thread(target=self.run, name="I/O loop")
+			self.thread.start()
+			self.startWorkers(0, self.workers)
+	def startWorkers(self, first, last):
+		for idx in range(first, last):
+			worker = threading.Thread(target=self.__worker, name="I/O loop worker %d" % (idx+1))
+			worker.daemon = True		# may be stuck in a blocking call nobody is waiting for
+			worker.start()
+	# grow or shrink the pool, a worker told to go finishes whatever call it's in first
+	def setWorkers(self, workers):
+		if self.thread is not None and self.running:
+			if workers > self.workers:
+				self.startWorkers(self.workers, workers)
+			for idx in range(workers, self.workers):
+				self.work.put(None)
+		self.workers = workers
+	def stop(self):
+		self.running = False
+		for idx in range(self.workers):
+			self.work.put(None)
+		self.wake()
+
+	def inLoop(self):
+		return threading.current_thread() is self.thread
+	def wake(self):
+		try:
+			self.wakeSend.send('x')
+		except socket.error:
+			pass
+
+	# these are safe to call from any thread
+	def callSoon(self, callback, *args):
+		self.calls.append((callback, args))
+		if not self.inLoop():
+			self.wake()
+	def runInExecutor(self, func, callback):
+		self.work.put((func, callback))
+
+	# these must be called on the loop thread
+	def callLater(self, delay, callback, *args):
+		timer = [time.time() + delay, self.order.next(), callback, args]
+		heapq.heappush(self.timers, timer)
+		return timer
+	def cancelTimer(self, timer):
+		timer[2] = None
+	def addReader(self, fd, callback):
+		self.readers[fd] = callback
+	def removeReader(self, fd):
+		self.readers.pop(fd, None)
+	def addWriter(self, fd, callback):
+		self.writers[fd] = callback
+	def removeWriter(self, fd):
+		self.writers.pop(fd, None)
+
+	def run(self):
+		while self.running:
+			timeout = None
+			if self.calls:
+				timeout = 0
+			elif self.timers:
+				timeout = max(0, self.timers[0][0] - time.time())
+			try:
+				readable, writable, broken = select.select(self.readers.keys() + [self.wakeRecv], self.writers.keys(), [], timeout)
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			for fd in readable:
+				if fd is self.wakeRecv:
+					self.__drainWakeup()
+				elif fd in self.readers:
+					self.__dispatch(self.readers[fd], ())
+			for fd in writable:
+				if fd in self.writers:
+					self.__dispatch(self.writers[fd], ())
+			now = time.time()
+			while self.timers and self.timers[0][0] <= now:
+				timer = heapq.heappop(self.timers)
+				if timer[2] is not None:
+					self.__dispatch(timer[2], timer[3])
+			for idx in range(len(self.calls)):
+				callback, args = self.calls.popleft()
+				self.__dispatch(callback, args)
+		self.wakeRecv.close()
+		self.wakeSend.close()
+
+	def __drainWakeup(self):
+		try:
+			while self.wakeRecv.recv(4096):
+				pass
+		except socket.error:
+			pass
+	def __dispatch(self, callback, args):
+		try:
+			callback(*args)
+		except Exception:
+			traceback.print_exc()
+	def __worker(self):
+		while True:
+			item = self.work.get()
+			if item is None:
+				return
+			func, callback = item
+			try:
+				result, error = func(), None
+			except Exception:
+				result, error = None, sys.exc_info()
+			self.callSoon(callback, result, error)
+
+class AsyncTask(Task):
+	"""A task run by callbacks on its controller's IoLoop rather than on a thread of its own, although anything
+	it passes to runInExecutor() has one of the loop's workers to itself until it returns.  Subclasses
+	implement begin() and call finish() when they're done"""
+	def __init__(self):
+		Task.__init__(self)
+		self.loop = None
+		self.watching = set()		# (fd, isWrite)
+		self.timers = {}			# seq -> timer
+	def start(self, tasks = None):
+		if self.status != Task.tsRUNNING:
+			self.loop = tasks.getLoop()
+			self.loop.callSoon(self.__begin)
+	def stop(self, tasks = None):
+		if self.loop is not None:
+			self.loop.callSoon(self.finish, Task.tsCANCELLED)
+	def active(self):
+		return self.status == Task.tsRUNNING
+	def __begin(self):
+		self.statusChanged(Task.tsRUNNING)
+		self.guard(self.begin)()
+	def begin(self):
+		pass
+	def cleanup(self):
+		pass
+	def finish(self, status = Task.tsCOMPLETE):
+		if self.status != Task.tsRUNNING:
+			return
+		for fd, isWrite in self.watching:
+			if isWrite:
+				self.loop.removeWriter(fd)
+			else:
+				self.loop.removeReader(fd)
+		self.watching = set()
+		for timer in self.timers.itervalues():
+			self.loop.cancelTimer(timer)
+		self.timers = {}
+		try:
+			self.cleanup()
+		finally:
+			self.statusChanged(status)
+
+	# wrap a callback so an exception fails the task, and so it's ignored once the task is finished
+	def guard(self, callback):
+		def guarded(*args):
+			if self.active():
+				try:
+					callback(*args)
+				except Exception:
+					traceback.print_exc()
+					self.finish(Task.tsFAILED)
+		return guarded
+	def watchRead(self, fd, callback):
+		self.watching.add((fd, False))
+		self.loop.addReader(fd, self.guard(callback))
+	def watchWrite(self, fd, callback):
+		self.watching.add((fd, True))
+		self.loop.addWriter(fd, self.guard(callback))
+	def unwatch(self, fd):
+		if (fd, False) in self.watching:
+			self.watching.remove((fd, False))
+			self.loop.removeReader(fd)
+		if (fd, True) in self.watching:
+			self.watching.remove((fd, True))
+			self.loop.removeWriter(fd)
+	def callLater(self, delay, callback, *args):
+		guarded = self.guard(callback)
+		def fired(*args):
+			del self.timers[timer[1]]
+			guarded(*args)
+		timer = self.loop.callLater(delay, fired, *args)
+		self.timers[timer[1]] = timer
+		return timer
+	# run func on one of the loop's worker threads, then callback(result) on the loop
+	def runInExecutor(self, func, callback):
+		def completed(result, error):
+			if error is not None:
+				if self.active():
+					traceback.print_exception(*error)
+					self.finish(Task.tsFAILED)
+			else:
+				self.guard(callback)(result)
+		self.loop.runInExecutor(func, completed)
+	def __repr__(self):
+		return "<AsyncTask: %s>" % self.name()
+
+class ToolTask(Task):
+	"""Runs an external tool.  Its output is gathered by the controller's Multiplexer rather than a thread of
+	our own, it holds a cpu slot while it runs, and it completes or fails by the tool's exit status"""
+	SLOTS = { 'cpu': 1 }
+	OUTPUT_TAIL = 64 * 1024			# how much of each of stdout and stderr to keep
+	SECRET_FLAGS = frozenset(['--mak'])	# options whose values (a tivo's media access key) are kept out of names and logs
+
+	def __init__(self, xform, args, input = None, onComplete = None, cwd = None, source = None):
+		Task.__init__(self)
+		self.xform = xform
+		self.args = args				# an argument list, never a shell string
+		self.input = input
+		self.onComplete = onComplete	# called with the task when the tool exits cleanly, before we say so
+		self.cwd = cwd
+		self.source = source			# returns a file object to feed the tool's stdin from, opened once we're running
+		self.feedError = None
+		self.proc = None
+		self.mux = None
+		self.output = { 'stdout': collections.deque(), 'stderr': collections.deque() }
+		self.outputSize = { 'stdout': 0, 'stderr': 0 }
+		self.openPipes = 0
+		self.returncode = None
+		self.cancelled = False
+		self.lock = threading.Lock()
+	def name(self):
+		shown = []
+		secret = False
+		for arg in self.args:
+			if secret:
+				arg = '****'
+			shown.append(arg)
+			secret = arg in self.SECRET_FLAGS
+		return "Tool: %s" % ' '.join(shown)
+	def transform(self):
+		return self.xform
+	def outputText(self, which = 'stdout'):
+		return ''.join(self.output[which])
+
+	def start(self, tasks = None):
+		if self.status != Task.tsQUEUED:
+			return
+		try:
+			stdin = pipesubproc.PIPE
+			if self.source is None:
+				stdin = open(os.devnull, 'rb')
+			try:
+				self.proc = pipesubproc.Popen(self.args, stdin=stdin, stdout=pipesubproc.PIPE, stderr=pipesubproc.PIPE, cwd=self.cwd)
+			finally:
+				if self.source is None:
+					stdin.close()
+		except OSError:
+			traceback.print_exc()
+			self.statusChanged(Task.tsFAILED)
+			return
+		self.statusChanged(Task.tsRUNNING)
+		self.openPipes = 2
+		if tasks is not None:
+			self.mux = tasks.getMultiplexer()
+		if self.mux is not None:
+			self.mux.register(self.proc, self.__onOutput)
+		else:
+			threading.Thread(target=self.__communicate, name=self.name()).start()
+		if self.source is not None:
+			threading.Thread(target=self.__feed, name=self.name() + ' (input)').start()
+	def stop(self, tasks = None):
+		with self.lock:
+			if self.proc is None or self.returncode is not None or self.cancelled:
+				return
+			self.cancelled = True
+			try:
+				self.proc.terminate()
+			except OSError:
+				pass			# it beat us to it
+			if self.mux is not None:
+				# anything it started may still hold the pipes open, so stop listening rather than wait for them
+				self.mux.unregister(self.proc)
+				threading.Thread(target=self.__exited, name=self.name()).start()
+
+	def __keep(self, which, data):
+		self.output[which].append(data)
+		self.outputSize[which] += len(data)
+		while self.outputSize[which] > self.OUTPUT_TAIL and len(self.output[which]) > 1:
+			self.outputSize[which] -= len(self.output[which].popleft())
+	def __onOutput(self, proc, which, data):
+		if data is not None:
+			self.__keep(which, data)
+			return
+		if which == 'stdin':
+			return
+		self.openPipes -= 1
+		if not self.openPipes:
+			# both pipes closed, it has exited or is about to: don't hold up the multiplexer waiting for it
+			if proc.poll() is None:
+				threading.Thread(target=self.__exited, name=self.name()).start()
+			else:
+				self.__exited()
+	# a stream of unknown length can only be pumped by blocking on it, so that gets a thread of its own
+	def __feed(self):
+		source = None
+		try:
+			source = self.source()
+			if hasattr(pipesubproc, 'send_stream'):
+				pipesubproc.send_stream(self.proc, source)
+			else:
+				shutil.copyfileobj(source, self.proc.stdin)
+		except Exception as e:
+			if not self.cancelled:
+				traceback.print_exc()
+				self.feedError = e
+				self.stop()
+		finally:
+			if source is not None:
+				source.close()
+			if self.mux is not None:
+				self.mux.closeStdin(self.proc)
+			elif self.proc.stdin is not None:
+				self.proc.stdin.close()
+	def __communicate(self):
+		if self.source is None:
+			out, err = self.proc.communicate()
+			self.__keep('stdout', out)
+			self.__keep('stderr', err)
+		else:
+			# communicate() would close the stdin we're still feeding, so read the two outputs a thread apiece
+			drain = threading.Thread(target=self.__drain, args=('stderr',), name=self.name())
+			drain.start()
+			self.__drain('stdout')
+			drain.join()
+		self.__exited()
+	def __drain(self, which):
+		pipe = getattr(self.proc, which)
+		while True:
+			data = os.read(pipe.fileno(), 64 * 1024)
+			if not data:
+				break
+			self.__keep(which, data)
+		pipe.close()
+	def __exited(self):
+		returncode = self.proc.wait()
+		with self.lock:
+			if self.returncode is not None:
+				return			# cancelled, and the multiplexer noticed too
+			self.returncode = returncode
+		if self.feedError is not None:
+			print "%s failed reading its input: %s" % (self.name(), self.feedError)
+			self.statusChanged(Task.tsFAILED)
+		elif self.cancelled:
+			self.statusChanged(Task.tsCANCELLED)
+		elif self.returncode != 0:
+			print "%s exited with %d: %s" % (self.name(), self.returncode, self.outputText('stderr')[-1024:])
+			self.statusChanged(Task.tsFAILED)
+		else:
+			try:
+				if self.onComplete is not None:
+					self.onComplete(self)
+			except Exception:
+				traceback.print_exc()
+				self.statusChanged(Task.tsFAILED)
+				return
+			self.statusChanged(Task.tsCOMPLETE)
+	def __repr__(self):
+		return "<ToolTask: %s>" % self.name()
+
 class TaskController(object):
-	def __init__(self, env = None):
-		self.messages = MessageQueue()
+	BATCH_SIZE = 256
+	RESOURCE_LIMIT = 1				# how many admitted tasks may lock or consume one asset at a time
+	AGING_INTERVAL = 60				# a queued task gains one priority level for every this many seconds it waits
+	RESCHEDULE_INTERVAL = 5.0		# seconds between tries at a task refused for something we won't hear about (disk space)
+	SLOT_LIMITS = { 'cpu': multiprocessing.cpu_count(), 'net': 4 }
+
+	def __init__(self, env = None, maxTasks = None, maxMessages = 0, overflow = MessageQueue.ovBLOCK, loop = None, slots = None):
+		self.messages = MessageQueue(maxMessages, overflow, Notification.coalesceKey)
+		self.loop = loop				# IoLoop running any AsyncTasks, created when the first one starts
 		self.observers = Observable()
+		self.batchObservers = Observable()
 		self.tasks = set()
 		self.xforms = {}
+		self.maxTasks = maxTasks		# how many unfinished tasks we're willing to hold, None for no limit
+		self.schedLock = threading.RLock()
+		self.runQueue = []				# tasks waiting for admission, ordered by schedule()
+		self.queueOrder = itertools.count()
+		self.admitted = set()			# tasks holding resources and slots
+		self.resourceLimits = {}		# asset -> limit, for assets that don't use RESOURCE_LIMIT
+		self.resourcesHeld = {}			# asset -> number of admitted tasks holding it
+		self.slotLimits = dict(self.SLOT_LIMITS)
+		if slots is not None:
+			self.slotLimits.update(slots)
+		self.slotsUsed = {}
+		self.rescheduleTimer = None
+		self.rescheduleAt = None
+		self.multiplexer = None			# watches the pipes of any ToolTasks, created when the first one starts
 		if env is not None:
 			self.observeEnvironment(env)
 	def queueNotify(self, task, msg):
+		if msg.type == Notification.ntSTATUS and msg.value in Task.FINISHED and msg.task in self.admitted:
+			self.release(msg.task)
+			self.schedule()
 		self.messages.enqueue(msg)
 	def addTask(self, task):
-		if task in self.tasks:
-			raise RuntimeError('Task is already a member of this controller');
-		task.addObserver(self.queueNotify)
-		self.tasks.add(task)
-		xform = task.transform()
-		if xform is not None:
-			if xform not in self.xforms:
-				self.xforms[xform] = set()
-			self.xforms[xform].add(task)
-		task.start(self)
+		with self.schedLock:
+			if task in self.tasks:
+				raise RuntimeError('Task is already a member of this controller');
+			task.addObserver(self.queueNotify)
+			self.tasks.add(task)
+			xform = task.transform()
+			if xform is not None:
+				if xform not in self.xforms:
+					self.xforms[xform] = set()
+				self.xforms[xform].add(task)
+			task.queuedAt = time.time()
+			task.queueSeq = self.queueOrder.next()
+			self.runQueue.append(task)
+		self.schedule()
 	def removeTask(self, task):
-		if task in self.tasks:
+		with self.schedLock:
+			if task not in self.tasks:
+				return
 			task.removeObserver(self.queueNotify)
-			task.stop(self)
 			self.tasks.remove(task)
 			xform = task.transform()
 			if xform is not None:
 				if xform in self.xforms and task in self.xforms[xform]:
 					self.xforms[xform].remove(task)
+			wasQueued = task in self.runQueue
+			if wasQueued:
+				self.runQueue.remove(task)
+			if task in self.admitted:
+				self.release(task)
+		if not wasQueued:
+			task.stop(self)
+		self.schedule()
+
+	def setResourceLimit(self, asset, limit):
+		with self.schedLock:
+			self.resourceLimits[asset] = limit
+		self.schedule()
+	def setSlotLimit(self, slot, limit):
+		with self.schedLock:
+			self.slotLimits[slot] = limit
+			if self.loop is not None:
+				self.loop.setWorkers(self.loopWorkers())
+		self.schedule()
+	# every task holding a net slot may have a blocking call on the loop's workers, and one over for the rest
+	def loopWorkers(self):
+		return self.slotLimits.get('net', 0) + 1
+
+	# could this task run now alongside everything already admitted?
+	def admissible(self, task):
+		for asset in task.resources():
+			if self.resourcesHeld.get(asset, 0) >= self.resourceLimits.get(asset, self.RESOURCE_LIMIT):
+				return False
+		for slot, count in task.slots().iteritems():
+			used = self.slotsUsed.get(slot, 0)
+			if used and used + count > self.slotLimits.get(slot, used + count):
+				return False		# (a task wanting more than the whole limit still runs once the slot is idle)
+		return True
+	def admit(self, task):
+		self.admitted.add(task)
+		for asset in task.resources():
+			self.resourcesHeld[asset] = self.resourcesHeld.get(asset, 0) + 1
+		for slot, count in task.slots().iteritems():
+			self.slotsUsed[slot] = self.slotsUsed.get(slot, 0) + count
+	def release(self, task):
+		with self.schedLock:
+			if task not in self.admitted:
+				return
+			self.admitted.remove(task)
+			for asset in task.resources():
+				self.resourcesHeld[asset] -= 1
+				if not self.resourcesHeld[asset]:
+					del self.resourcesHeld[asset]
+			for slot, count in task.slots().iteritems():
+				self.slotsUsed[slot] -= count
+		task.unreserve()
+
+	# highest (aged) priority first, then earliest deadline, then cheapest, then first come
+	def queueKey(self, task, now):
+		waited = int((now - task.queuedAt) / self.AGING_INTERVAL)
+		deadline = task.deadline
+		if deadline is None:
+			deadline = float('inf')
+		return (-(task.priority + waited), deadline, task.cost(), task.queueSeq)
+
+	# when a waiting task next gains a priority level
+	def nextAging(self, task, now):
+		return task.queuedAt + (int((now - task.queuedAt) / self.AGING_INTERVAL) + 1) * self.AGING_INTERVAL
+
+	# start every queued task that fits, skipping over (but not forgetting) the ones that don't
+	def schedule(self):
+		with self.schedLock:
+			starting = []
+			waiting = []
+			now = time.time()
+			refused = False
+			self.runQueue.sort(key=lambda task: self.queueKey(task, now))
+			for task in self.runQueue:
+				if not self.admissible(task):
+					waiting.append(task)
+				elif task.reserve():
+					self.admit(task)
+					starting.append(task)
+				else:
+					waiting.append(task)
+					refused = True
+			self.runQueue = waiting
+			if refused:
+				self.rescheduleLater(self.RESCHEDULE_INTERVAL)
+			if waiting:
+				# so a task's aging counts even if nothing else happens before its next level
+				self.rescheduleLater(min([self.nextAging(task, now) for task in waiting]) - now)
+		for task in starting:
+			task.start(self)
+	# schedule again within delay seconds, even if no task comes, goes or finishes before then
+	def rescheduleLater(self, delay):
+		with self.schedLock:
+			when = time.time() + delay
+			if self.rescheduleTimer is not None:
+				if self.rescheduleAt <= when:
+					return
+				self.rescheduleTimer.cancel()
+			self.rescheduleAt = when
+			self.rescheduleTimer = threading.Timer(delay, self.__rescheduleDue)
+			self.rescheduleTimer.daemon = True
+			self.rescheduleTimer.start()
+	def __rescheduleDue(self):
+		with self.schedLock:
+			if self.rescheduleTimer is not threading.current_thread():
+				return			# replaced by a sooner one
+			self.rescheduleTimer = None
+		self.schedule()
+	def accepting(self):
+		if self.maxTasks is None:
+			return True
+		unfinished = 0
+		for task in self.tasks:
+			if task.status == Task.tsQUEUED or task.status == Task.tsRUNNING:
+				unfinished += 1
+		return unfinished < self.maxTasks
 	def tasksByTransform(self, xform):
 		if xform in self.xforms:
 			return self.xforms[xform]
@@ -183,104 +1034,188 @@ class TaskController(object):
 		env.addObserver(self.queueNotify)
 	def unobserveEnvironment(self, env):
 		env.removeObserver(self.queueNotify)
+	def addBatchObserver(self, obj):
+		self.batchObservers.add(obj)
+	def removeBatchObserver(self, obj):
+		self.batchObservers.remove(obj)
 	def handleMessages(self, block=False, timeout=None):
-		self.messages.handle(self.__onMessage, None, block, timeout)
-	def __onMessage(self, msg):
-		print 'Received message: ', msg
-		self.observers.notifyObservers(msg)
+		self.messages.handleBatch(self.__onMessages, None, block, timeout, self.BATCH_SIZE)
+	def __onMessages(self, msgs):
+		for msg in msgs:
+			print 'Received message: ', msg
+			self.observers.notifyObservers(msg)
+		self.batchObservers.notifyObservers(msgs)
 	def dump(self):
 		print len(self.tasks), "tasks listed"
 		idx = 1
 		for task in self.tasks:
 			print "%d: %s (%s)" % (idx, task.name(), Task.STATUS_STRING[task.status])
 			idx += 1
+	def getLoop(self):
+		if self.loop is None:
+			self.loop = IoLoop(self.loopWorkers())
+		self.loop.start()
+		return self.loop
+	# None where there's no Multiplexer (windows), ToolTasks wait on a thread each there
+	def getMultiplexer(self):
+		if not hasattr(pipesubproc, 'Multiplexer'):
+			return None
+		with self.schedLock:
+			if self.multiplexer is None:
+				self.multiplexer = pipesubproc.Multiplexer()
+				self.multiplexer.start()
+		return self.multiplexer
 	def stop(self):
+		with self.schedLock:
+			queued = self.runQueue
+			self.runQueue = []
+			if self.rescheduleTimer is not None:
+				self.rescheduleTimer.cancel()
+				self.rescheduleTimer = None
+		for task in queued:
+			task.statusChanged(Task.tsCANCELLED)
 		for task in self.tasks:
-			task.stop()
+			if task not in queued:
+				task.stop()
+		if self.loop is not None:
+			self.loop.callSoon(self.loop.stop)		# after the tasks have had a chance to finish
+		if self.multiplexer is not None:
+			self.multiplexer.close()
+			self.multiplexer = None
 
 ###############################################################################
 
 class Goal(object):
-	def __init__(self, ph):
+	def __init__(self, ph, priority = 0, deadline = None):
 		self.placeholder = ph
+		self.priority = priority		# handed down to the tasks launched for this goal
+		self.deadline = deadline
 		
 	# can the specified environment contain something that satisfies this asset requirement?
 	def isDependancyResolved(self, phAsset, env):
 		assert(env is not None)
-		assets = env.getAssetsByType(phAsset.type)
-		if assets is None:
-			return None
-		#print "isDependancyResolved: %s" % phAsset
-		for foundAsset in assets:
-			#print "-->looking at %s" % foundAsset
-			if phAsset.type == foundAsset.type and foundAsset.satisfies(phAsset):
-				return foundAsset
+		return env.findAsset(phAsset)
 
 	def resolveDependancy(self, phAsset, env):
 		assert(env is not None)
-		assets = env.getAssetsByType(phAsset.type)
-		if assets is None:
-			return None
-		results = []
-		for foundAsset in assets:
-			if phAsset.type == foundAsset.type and foundAsset.satisfies(phAsset):
-				results.append(foundAsset)
-		return results
+		return env.findAssets(phAsset)
 
 	# what steps can we do to get to an asset with the specified pattern?
-	def findChain(self, env = None):
+	def findChain(self, env = None, bestFirst = False, processes = None, **budget):
 	#	if env is not None:
 	#		localAsset = self.isDependancyResolved(self.placeholder, env)
 	#		if localAsset is not None:
 	#			return set([localAsset])
 
-		specs = set()
-		chains = self.__transformSearch(self.placeholder)
-		while chains:
-			for element in chains:
-				#print "deps came back for " + str(element)
-				if env is not None:
-					depends = self.getUnresolvedSpecDependancies(element, env)
-					if not depends:
+		if bestFirst:
+			return set(self.searchChains(env, **budget))
+
+		pool = None
+		if processes is not None and sys.platform == 'win32':
+			# without fork the workers would have to be sent env (a CatalogEnvironment's database connection
+			# won't pickle) and re-register transforms from __main__, so plan here instead
+			processes = None
+		if processes is not None:
+			# the workers need the same transforms registered (which fork gives us for free)
+			modules = set([transform.__class__.__module__ for transform in avail_transforms])
+			pool = multiprocessing.Pool(processes, initPlanner, (sorted(modules), env))
+		try:
+			table = base.SpecTable()
+			specs = set()
+			chains = self.__transformSearch(self.placeholder, table = table)
+			while chains:
+				for element in chains:
+					#print "deps came back for " + str(element)
+					if env is not None:
+						depends = self.getUnresolvedSpecDependancies(element, env)
+						if not depends:
+							specs.add(element)
+					else:
 						specs.add(element)
+				# given a list of specs, attempt to find other transforms to add onto it to extend the possible chain
+				extendedSpecs = set()
+				if pool is not None and len(chains) > 1:
+					chains = list(chains)
+					shardSize = max(1, len(chains) / (processes * 4))
+					shards = [avail_transforms.dumps(chains[idx:idx+shardSize]) for idx in range(0, len(chains), shardSize)]
+					for result in pool.imap_unordered(expandShard, shards):
+						for spec in avail_transforms.loads(result):
+							extendedSpecs.add(table.spec(spec))
 				else:
-					specs.add(element)
-			# given a list of specs, attempt to find other transforms to add onto it to extend the possible chain
-			extendedSpecs = set()
-			for spec in chains:
-				#print "trying to extend " + str(spec)
-				deps = self.getUnresolvedSpecDependancies(spec, env)
-				for dep in deps:
-					theseSpecs = self.__transformSearch(dep)
-					for thisSpec in theseSpecs:
-						if thisSpec.joinableAsChild(spec):
-							#print "COMBINE " + str(thisSpec) + " + " + str(spec)
-							combinedSpec = thisSpec.combineAsChild(spec)
-							#print "COMBINE-result " + str(combinedSpec)
-							extendedSpecs.add(combinedSpec)
-			chains = extendedSpecs
-		return specs
+					for spec in chains:
+						#print "trying to extend " + str(spec)
+						extendedSpecs.update(self.extendSpec(spec, env, table))
+				chains = extendedSpecs
+			return specs
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+
+	# what specs can be made by putting another transform in front of this one?
+	def extendSpec(self, spec, env = None, table = None):
+		if table is None:
+			table = base.SpecTable()
+		extendedSpecs = set()
+		deps = self.getUnresolvedSpecDependancies(spec, env)
+		for dep in deps:
+			theseSpecs = self.__transformSearch(dep, table = table)
+			for thisSpec in theseSpecs:
+				if thisSpec.joinableAsChild(spec):
+					#print "COMBINE " + str(thisSpec) + " + " + str(spec)
+					combinedSpec = table.combine(thisSpec, spec)
+					#print "COMBINE-result " + str(combinedSpec)
+					extendedSpecs.add(combinedSpec)
+		return extendedSpecs
+
+	@staticmethod
+	def transformCost(transform):
+		return transform.cost()
+
+	# yields the specs findChain() would find, cheapest first.  The search stops expanding chains once
+	# they contain maxDepth transforms or maxExpansions specs have been expanded, and stops altogether
+	# after timeLimit seconds or maxResults specs; whatever was found up to that point is still good
+	def searchChains(self, env = None, costModel = None, maxDepth = None, maxExpansions = None, timeLimit = None, maxResults = None):
+		if costModel is None:
+			costModel = Goal.transformCost
+		deadline = None
+		if timeLimit is not None:
+			deadline = time.time() + timeLimit
+		table = base.SpecTable()
+		queue = []
+		seen = set()
+		order = itertools.count()
+		def push(spec):
+			if spec not in seen:
+				seen.add(spec)
+				cost = sum([costModel(transform) for transform in spec.transforms])
+				heapq.heappush(queue, (cost, order.next(), spec))
+
+		for spec in self.__transformSearch(self.placeholder, table = table):
+			push(spec)
+		expansions = 0
+		results = 0
+		while queue:
+			if deadline is not None and time.time() > deadline:
+				return
+			cost, idx, spec = heapq.heappop(queue)
+			if env is None or not self.getUnresolvedSpecDependancies(spec, env):
+				yield spec
+				results += 1
+				if maxResults is not None and results >= maxResults:
+					return
+			if maxDepth is not None and len(spec.transforms) >= maxDepth:
+				continue
+			if maxExpansions is not None and expansions >= maxExpansions:
+				continue
+			expansions += 1
+			for combinedSpec in self.extendSpec(spec, env, table):
+				push(combinedSpec)
 
-	def __transformSearch(self, phAsset, isWeak = True):
-		#global avail_transforms		not necessary as we're only reading?
-		specs = set()
-		for transform in avail_transforms:
-			spec = transform.spec()
-			if spec.transforms is None:
-				spec.transforms = tuple([ transform ])
-			assert(spec is not None)
-			if spec.canProduce(phAsset):
-				specs.add(spec)
-			elif isWeak and isinstance(phAsset, base.AssetPlaceholder):
-				product = spec.canWeaklyProduce(phAsset)
-				if product is not None:
-					extras = phAsset.weaklySatisfiedBy(product)
-					newSpec = copy.copy(spec)
-					if newSpec.extras is None:
-						newSpec.extras = {}
-					for extraKey in extras:
-						newSpec.extras[extraKey] = extras[extraKey]
-					specs.add(newSpec)
+	def __transformSearch(self, phAsset, isWeak = True, table = None):
+		specs = avail_transforms.producersOf(phAsset, isWeak)
+		if table is not None:
+			specs = set([table.spec(spec) for spec in specs])
 		return specs
 
 	# what requirements does the spec have that are not satisfied by the env (if specified) ?
@@ -314,95 +1249,217 @@ class Goal(object):
 		return newVal
 		
 	def resolveSpecDependancies(self, spec, env, extras):
-		input = [()]
+		return list(self.iterSpecDependancies(spec, env, extras))
+
+	# yields each tuple of assets in env that can be fed into spec, one at a time (and no more than limit)
+	def iterSpecDependancies(self, spec, env, extras, limit = None):
 		specInputs = []
-		if spec.requires is not None:
-			for val in spec.requires:
-				newVal = self.combinePh(val, extras)
-				input = self.__mixSpecDependency(input, specInputs, newVal, env)
-				specInputs.append(newVal)
-		if spec.consumes is not None:
-			for val in spec.consumes:
-				newVal = self.combinePh(val, extras)
-				input = self.__mixSpecDependency(input, specInputs, newVal, env)
-				specInputs.append(newVal)
-		if spec.locks is not None:
-			for val in spec.locks:
-				newVal = self.combinePh(val, extras)
-				input = self.__mixSpecDependency(input, specInputs, newVal, env)
-				specInputs.append(newVal)
-		#print input
-		return input
-		
-	def __mixSpecDependency(self, input, specInputs, val, env):
-		newInput = []
-		for itemList in input:
-			assert(len(itemList) == len(specInputs))
-			thisVal = val
-			if itemList:
-				replList = {}
-				for idx in range(len(itemList)):
-					specInput = specInputs[idx]
-					if isinstance(specInput, base.AssetPlaceholder):
-						specInput.findReplacements(itemList[idx], replList)
-				thisVal = thisVal.copy()
-				thisVal.instantiatePlaceholder(replList)
-			avail = self.resolveDependancy(thisVal, env)
-			#print "%s -> %s" % (thisVal, avail)
-			for availItem in avail:
-				newItem = list(itemList)
-				newItem.append(availItem)
-				newInput.append(tuple(newItem))
-		return newInput
+		for phList in (spec.requires, spec.consumes, spec.locks):
+			if phList is not None:
+				for val in phList:
+					specInputs.append(self.combinePh(val, extras))
+		count = 0
+		for input in self.__iterSpecDependancy((), specInputs, env):
+			yield input
+			count += 1
+			if limit is not None and count >= limit:
+				return
+
+	def __iterSpecDependancy(self, itemList, specInputs, env):
+		if len(itemList) == len(specInputs):
+			yield itemList
+			return
+		thisVal = specInputs[len(itemList)]
+		if itemList:
+			replList = {}
+			for idx in range(len(itemList)):
+				specInput = specInputs[idx]
+				if isinstance(specInput, base.AssetPlaceholder):
+					specInput.findReplacements(itemList[idx], replList)
+			thisVal = thisVal.copy()
+			thisVal.instantiatePlaceholder(replList)
+		for availItem in self.resolveDependancy(thisVal, env):
+			for input in self.__iterSpecDependancy(itemList + (availItem,), specInputs, env):
+				yield input
 
 	def __repr__(self):
 		return "<Goal: %s>" % repr(self.placeholder)
 
+# the parallel side of Goal.findChain, these run in the worker processes
+plannerEnv = None
+def initPlanner(modules, env):
+	global plannerEnv
+	for module in modules:
+		if module != '__main__':
+			__import__(module)
+	plannerEnv = env
+def expandShard(data):
+	goal = Goal(None)
+	table = base.SpecTable()
+	extendedSpecs = set()
+	for spec in avail_transforms.loads(data):
+		extendedSpecs.update(goal.extendSpec(spec, plannerEnv, table))
+	return avail_transforms.dumps(extendedSpecs)
+
+class ChainCache(object):
+	"""On-disk store of the libraries computed by Goal.findChain, keyed by the shape of the goal
+	and the fingerprint of the transforms that were available when it was computed"""
+	VERSION = 1
+
+	def __init__(self, filename, registry = None):
+		self.registry = registry
+		if self.registry is None:
+			self.registry = avail_transforms
+		self.lock = threading.Lock()
+		self.db = dbdict.dbopen(filename, format='pickle', journal=True)
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	def keyPrefix(self):
+		return 'v%d:%s:' % (self.VERSION, self.registry.fingerprint())
+	def key(self, goal):
+		return self.keyPrefix() + hashlib.sha1(repr(goal.placeholder.shape())).hexdigest()
+
+	def lookup(self, goal):
+		with self.lock:
+			data = self.db.get(self.key(goal))
+		if data is None:
+			return None
+		try:
+			return self.registry.loads(data)
+		except Exception:
+			return None		# something we can't resolve anymore, treat it as a miss
+
+	def store(self, goal, library):
+		data = self.registry.dumps(set(library))
+		prefix = self.keyPrefix()
+		with self.lock:
+			# anything computed against a different set of transforms is useless now
+			for key in [key for key in self.db if not key.startswith(prefix)]:
+				del self.db[key]
+			self.db[self.key(goal)] = data
+			self.db.sync()
+
 class GoalTask(Task):
-	def __init__(self, env, goal, findAll = True):
+	def __init__(self, env, goal, findAll = True, cache = None, budget = None):
 		Task.__init__(self)
 		self.env = env
 		self.goal = goal
+		self.priority = goal.priority
+		self.deadline = goal.deadline
 		self.findAll = findAll
-		self.library = self.goal.findChain()
-		self.stale = False
+		self.library = None
+		if budget is not None:
+			# a budgeted search depends on the budget (and the clock), so it doesn't go in the cache
+			self.library = self.goal.findChain(bestFirst=True, **budget)
+		else:
+			if cache is not None:
+				self.library = cache.lookup(goal)
+			if self.library is None:
+				self.library = self.goal.findChain()
+				if cache is not None:
+					cache.store(goal, self.library)
+		self.runnable = set()		# specs in the library whose dependancies are currently all resolved
+		self.stalled = False		# evaluate() stopped because the controller was full, so a task finishing calls it again
+		self.dependants = {}		# asset type -> {bound attributes -> (probe placeholder, set of specs)}
+		for spec in self.library:
+			for phList in (spec.requires, spec.consumes, spec.locks):
+				if phList is not None:
+					for ph in phList:
+						self.__addDependant(ph, spec)
 		print "%d goals collected in library" % len(self.library)
 	def start(self, tasks):
 		self.statusChanged(Task.tsRUNNING)
 		self.tasks = tasks
-		tasks.addObserver(self.__notify)
+		tasks.addBatchObserver(self.__notify)
+		self.recheck(self.library)
 		self.evaluate()
 	def stop(self):
 		self.statusChanged(Task.tsQUEUED)
 		if self.tasks is not None:
-			self.tasks.removeObserver(self.__notify)
+			self.tasks.removeBatchObserver(self.__notify)
 	def name(self):
 		return "Goal: " + repr(self.goal)
-	def __notify(self, task, msg):
-		if (msg.type == Notification.ntNEWASSET) or (msg.type == Notification.ntDEADASSET):
-			if not self.stale:
-				self.stale = True
-				self.tasks.queueNotify(self, Notification(self, Notification.ntDELAYNOTIFY, self))
-		elif msg.type == Notification.ntDELAYNOTIFY:
-			self.stale = False
+	def __notify(self, tasks, msgs):
+		affected = set()
+		finished = False
+		for msg in msgs:
+			if (msg.type == Notification.ntNEWASSET) or (msg.type == Notification.ntDEADASSET):
+				affected.update(self.affectedSpecs(msg.value))
+			elif msg.type == Notification.ntSTATUS and msg.value in Task.FINISHED:
+				finished = True
+		if affected:
+			self.recheck(affected)
+		if affected or (finished and self.stalled):
 			self.evaluate()
+
+	def __addDependant(self, ph, spec):
+		bound = {}
+		for attr in ph.attr:
+			if not isinstance(ph.attr[attr], base.TransformPlaceholder):
+				bound[attr] = ph.attr[attr]
+		byBound = self.dependants.setdefault(ph.type, {})
+		key = frozenset(bound.iteritems())
+		if key not in byBound:
+			byBound[key] = (base.AssetPlaceholder(ph.type, bound), set())
+		byBound[key][1].add(spec)
+
+	# which specs in the library might have changed state because of a change to this asset?
+	def affectedSpecs(self, asset):
+		affected = set()
+		byBound = self.dependants.get(asset.type)
+		if byBound:
+			for probe, specs in byBound.itervalues():
+				if asset.satisfies(probe):
+					affected.update(specs)
+		return affected
+
+	def recheck(self, specs):
+		for spec in specs:
+			if self.goal.getUnresolvedSpecDependancies(spec, self.env):
+				self.runnable.discard(spec)
+			else:
+				self.runnable.add(spec)
+
+	# the transform to fuse with spec's first step, if what that step makes goes nowhere but there
+	def fusion(self, spec):
+		if len(spec.transforms) < 2 or not spec.transforms[0].canFuse(spec.transforms[1]):
+			return None
+		intermediates = set([ph.type for ph in spec.transforms[0].spec().produces or ()])
+		if self.goal.placeholder.type in intermediates:
+			return None			# the goal wants it kept, so it has to be stored
+		for later in spec.transforms[2:]:
+			for phList in (later.spec().requires, later.spec().consumes, later.spec().locks):
+				for ph in phList or ():
+					if ph.type in intermediates:
+						return None
+		return spec.transforms[1]
+
 	def evaluate(self):
-		#availChain = set()
+		self.stalled = False
 		nextStep = set()
-		for element in self.library:
-			if not self.goal.getUnresolvedSpecDependancies(element, self.env):
-				#availChain.add(element)
-				nextStep.add((element.transforms[0],element.extras))
-
-		#print "%d steps(s) identified from %d available path(s)" % (len(nextStep), len(availChain))
-		for next in nextStep:
-			step = next[0]
-			extras = next[1]
-			instances = self.goal.resolveSpecDependancies(step.spec(), self.env, extras)
-			runningTasks = self.tasks.tasksByTransform(step)
-			for instance in instances:
+		for element in self.runnable:
+			nextStep.add((element.transforms[0],self.fusion(element),element.extras))
+
+		# fused steps first, so their first halves don't get launched on their own
+		for step, consumer, extras in sorted(nextStep, key=lambda next: next[1] is None):
+			for instance in self.goal.iterSpecDependancies(step.spec(), self.env, extras):
+				if not self.tasks.accepting():
+					self.stalled = True
+					return
+				runningTasks = self.tasks.tasksByTransform(step)
 				if runningTasks is None or not step.isRunning(runningTasks,instance,None):
 					try:
-						self.tasks.addTask(step.newTask(self.env,instance,None))
+						if consumer is not None:
+							newTask = step.fuse(consumer,self.env,instance,None)
+						else:
+							newTask = step.newTask(self.env,instance,None)
 					except TaskLaunchError as e:
-						pass
+						continue
+					if newTask is None:
+						continue
+					newTask.claim(step.spec(), instance)
+					newTask.priority = self.goal.priority
+					newTask.deadline = self.goal.deadline
+					self.tasks.addTask(newTask)
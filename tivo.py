@@ -1,7 +1,7 @@
-import socket, traceback, time, thread, urllib2, urllib, urlparse, sys, xml.sax, cookielib, json, os.path
-import base, task
+import socket, traceback, time, thread, urllib2, urllib, urlparse, sys, xml.sax, cookielib, json, os.path, errno, httplib, cStringIO
+import base, task, copyengine, storage
 from base import Asset, Transform, AssetPlaceholder
-from task import ThreadTask, TaskLaunchError
+from task import ThreadTask, AsyncTask, TaskLaunchError
 
 def formatFilesize(size):
 	if size == 1:
@@ -41,35 +41,38 @@ class TivoServerListenerTransform(Transform):
 	SPEC = base.TransformSpec()
 	SPEC.produces = [AssetPlaceholder('TivoServer', {'id': base.TransformPlaceholder(), 'mediaKey': base.TransformPlaceholder() })]
 	
-	def __init__(self):
+	def __init__(self, useLoop = False):
 		Transform.__init__(self)
+		self.useLoop = useLoop			# run the task on the controller's IoLoop rather than its own thread
 	def spec(self):
 		return self.SPEC
 	def newTask(self,env,input,output):
+		if self.useLoop:
+			return TivoServerListenerAsyncTask(self,env)
 		return TivoServerListenerTask(self,env)
 	def isRunning(self,tasks,input,output):
 		for task in tasks:
 			return True
 		return False
 	
-class TivoServerListenerTask(ThreadTask):
+class TivoServerListener(object):
+	"""Tracks the TiVos heard from on the broadcast port, shared by the threaded and event loop listeners"""
 	SOCKET_PORT    = 2190
 	SERVER_STALE   = 120
 	SERVER_EXPIRE  = 300
 	SOCKET_TIMEOUT = 10
 
-	def __init__(self, xform, env):
-		ThreadTask.__init__(self)
-		self.xform = xform
-		self.tivoStatus = {}					# no lock necessary as it's only ever looked at by the worker thread
-		self.env = env
-	
 	def name(self):
 		return "Tivo Broadcast Listener"
-	def stop(self):
-		self.threadStatus = ThreadTask.thrCANCELLING
 	def transform(self):
 		return self.xform
+
+	def openSocket(self):
+		s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+		s.bind(('', self.SOCKET_PORT))
+		return s
 		
 	def serverSeen(self, id, attrs):
 		if id in self.tivoStatus:
@@ -78,12 +81,15 @@ class TivoServerListenerTask(ThreadTask):
 				del self.tivoStatus[id]['stale']
 				self.tivoStatus[id]['asset'].delFlag(Asset.flagSTALE)
 			if self.tivoStatus[id]['attr'] != attrs:	# this only happens if something serious changed, like a version upgrade or the tivo rebooted or something
+				self.tivoStatus[id]['attr'] = attrs
 				self.tivoStatus[id]['asset'].resetAttrs(attrs)
+				if self.env is not None:
+					self.env.declareAsset(self.tivoStatus[id]['asset'])		# so a catalog picks up the change
 		else:
 			newServer = TivoServer(attrs)
-			self.tivoStatus[id] = {'attr': attrs, 'lastSeen': time.time(), 'asset': newServer }
 			if self.env is not None:
-				self.env.declareAsset(newServer)
+				newServer = self.env.declareAsset(newServer)		# may be one we remembered from last time
+			self.tivoStatus[id] = {'attr': attrs, 'lastSeen': time.time(), 'asset': newServer }
 
 	def pruneServers(self):
 		currentTime = time.time()
@@ -123,12 +129,18 @@ class TivoServerListenerTask(ThreadTask):
 				id = attrs['identity']
 				self.serverSeen(id, attrs)
 
+class TivoServerListenerTask(TivoServerListener, ThreadTask):
+	def __init__(self, xform, env):
+		ThreadTask.__init__(self)
+		self.xform = xform
+		self.tivoStatus = {}					# no lock necessary as it's only ever looked at by the worker thread
+		self.env = env
+	def stop(self):
+		self.threadStatus = ThreadTask.thrCANCELLING
+
 	def run(self):
-		s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+		s = self.openSocket()
 		s.settimeout(self.SOCKET_TIMEOUT)
-		s.bind(('', self.SOCKET_PORT))
 		while self.threadStatus == ThreadTask.thrRUNNING:
 			try:
 				self.pruneServers()
@@ -139,6 +151,37 @@ class TivoServerListenerTask(ThreadTask):
 		s.shutdown(socket.SHUT_RDWR)
 		s.close()
 
+class TivoServerListenerAsyncTask(TivoServerListener, AsyncTask):
+	def __init__(self, xform, env):
+		AsyncTask.__init__(self)
+		self.xform = xform
+		self.tivoStatus = {}					# only ever looked at on the loop thread
+		self.env = env
+		self.sock = None
+
+	def begin(self):
+		self.sock = self.openSocket()
+		self.sock.setblocking(0)
+		self.watchRead(self.sock, self.readable)
+		self.callLater(self.SOCKET_TIMEOUT, self.prune)
+	def cleanup(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+	def readable(self):
+		while True:
+			try:
+				message, address = self.sock.recvfrom(8192)
+			except socket.error as e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				raise
+			self.handleBcast(address[0], message)
+	def prune(self):
+		self.pruneServers()
+		self.callLater(self.SOCKET_TIMEOUT, self.prune)
+
 ###############################################################################
 class SimpleXmlObject(object):
 	def __init__(self):
@@ -277,14 +320,18 @@ class TivoServerQuery(object):
 			return None
 		return obj.document
 
-	def openSimplePath(self, addr):
+	# offset asks for everything from there on, check the response's code for whether the server obliged (206)
+	def openSimplePath(self, addr, offset = 0):
 		if self.opener is None:
 			self.initOpener(self.assembleUrl({'proto':addr['proto'], 'host':addr['host']}))
 		fullAddr = self.assembleUrl(addr)
+		request = urllib2.Request(fullAddr)
+		if offset:
+			request.add_header('Range', 'bytes=%d-' % offset)
 		
 		#retrieve the request
 		print "retrieving: " + fullAddr
-		return self.opener.open(fullAddr)
+		return self.opener.open(request)
 
 	def getVideoList(self, startAddr, threadTask = None, threadSeq = 0):
 		req = self.openXmlPath(startAddr)
@@ -363,6 +410,8 @@ class TivoServerQuery(object):
 
 ###############################################################################
 class TivoServer(Asset):
+	INDEXES = { 'id': None }
+
 	def __init__(self, attr):
 		Asset.__init__(self, 'TivoServer')
 		self.resetAttrs(attr)
@@ -391,6 +440,9 @@ class TivoServer(Asset):
 				addr['port'] = service['port']
 			return addr
 
+	def catalogKey(self):
+		return 'TivoServer:%s' % self.id
+
 	def satisfies(self, require):
 		if self.type != require.type:
 			return False
@@ -405,14 +457,17 @@ class TivoServerVideoDiscoveryTransform(Transform):
 	SPEC.requires = [AssetPlaceholder('TivoServer', {'id': base.TransformPlaceholder(), 'mediaKey': base.TransformPlaceholder() })]
 	SPEC.produces = [AssetPlaceholder('TivoVideo',  {'server': SPEC.requires[0].id })]
 	
-	def __init__(self):
+	def __init__(self, useLoop = False):
 		Transform.__init__(self)
+		self.useLoop = useLoop			# list on one of the controller's IoLoop workers rather than a thread of our own
 	def spec(self):
 		return self.SPEC
 	def newTask(self,env,input,output):
 		if input is None:
 			raise TaskLaunchError('inappropriate input arguments')
 		tivo = input[0]
+		if self.useLoop:
+			return TivoServerVideoDiscoveryAsync(self, tivo, env)
 		return TivoServerVideoDiscovery(self, tivo, env)
 	def isRunning(self,tasks,input,output):
 		if input is None:
@@ -423,47 +478,40 @@ class TivoServerVideoDiscoveryTransform(Transform):
 				return True
 		return False
 
-class TivoServerVideoDiscovery(ThreadTask):
-	def __init__(self, xform, tivo, env):
-		ThreadTask.__init__(self)
-		self.xform = xform
-		self.tivo = tivo
-		self.env = env
-		self.reqSeq = 0
-		self.reqExistVideos = None
-	
+class TivoServerVideoDiscoverer(object):
+	"""Lists the videos on a TiVo, shared by the threaded and event loop discovery tasks.  listVideos()
+	blocks in urllib2 so the event loop version runs it on one of the loop's workers"""
+	SLOTS = { 'net': 1 }
 	def name(self):
 		return "Tivo Video Discovery %s" % self.tivo
-	def stop(self):
-		self.threadStatus = ThreadTask.thrCANCELLING
 	def transform(self):
 		return self.xform
-		
-	def run(self):
-		addr = self.tivo.tivoAddr()
-		if addr is not None:
-			self.reqExistVideos = {}
-			existVideos = env.getAssetsByType('TivoVideo')
-			if existVideos is not None:
-				for video in existVideos:
-					if video.server == self.tivo:
-						self.reqExistVideos[video.tivoId] = video
-			
-			seq = self.reqSeq + 1
-			self.reqSeq = seq
-			with self.tivo.lock:
-				videoList = TivoServerQuery(self.tivo.mediaKey).getVideoList(addr, self, seq)
-			
-			if self.seqValid(seq):
-				# check for deleted videos
-				newVideos = dict(videoList)
-				for video in self.reqExistVideos:
-					if video.tivoId not in newVideos:
-						env.undeclareAsset(video)
-						video.close()
+
+	def nextSeq(self):
+		self.reqExistVideos = {}
+		existVideos = self.env.getAssetsByType('TivoVideo')
+		if existVideos is not None:
+			for video in existVideos:
+				if video.server == self.tivo:
+					self.reqExistVideos[video.tivoId] = video
+		self.reqSeq = self.reqSeq + 1
+		return self.reqSeq
+
+	def listVideos(self, addr, seq):
+		with self.tivo.lock:
+			return TivoServerQuery(self.tivo.mediaKey).getVideoList(addr, self, seq)
+
+	def listedVideos(self, seq, videoList):
+		if self.seqValid(seq):
+			# check for deleted videos
+			newVideos = dict(videoList)
+			for tivoId, video in self.reqExistVideos.items():
+				if tivoId not in newVideos:
+					self.env.undeclareAsset(video)
+					video.close()
 			
 	def seqValid(self, seq):
-		if self.threadStatus != ThreadTask.thrRUNNING:
+		if not self.active():
 			return False
 		if seq != self.reqSeq:
 			return False
@@ -472,13 +520,54 @@ class TivoServerVideoDiscovery(ThreadTask):
 	def foundVideo(self, seq, tivoId, video):
 		if not self.seqValid(seq):
 			return False
-		# check for added assets
-		if tivoId not in self.reqExistVideos:
+		# check for added assets, and confirm any we only remembered from last time
+		existing = self.reqExistVideos.get(tivoId)
+		if existing is None or existing.hasFlag(Asset.flagSTALE):
 			newVideo = TivoVideo(tivoId, self.tivo, video)
-			env.declareAsset(newVideo)
+			self.env.declareAsset(newVideo)
+
+class TivoServerVideoDiscovery(TivoServerVideoDiscoverer, ThreadTask):
+	def __init__(self, xform, tivo, env):
+		ThreadTask.__init__(self)
+		self.xform = xform
+		self.tivo = tivo
+		self.env = env
+		self.reqSeq = 0
+		self.reqExistVideos = None
+	def stop(self):
+		self.threadStatus = ThreadTask.thrCANCELLING
+		
+	def run(self):
+		addr = self.tivo.tivoAddr()
+		if addr is not None:
+			seq = self.nextSeq()
+			self.listedVideos(seq, self.listVideos(addr, seq))
+
+class TivoServerVideoDiscoveryAsync(TivoServerVideoDiscoverer, AsyncTask):
+	def __init__(self, xform, tivo, env):
+		AsyncTask.__init__(self)
+		self.xform = xform
+		self.tivo = tivo
+		self.env = env
+		self.reqSeq = 0
+		self.reqExistVideos = None
+
+	def begin(self):
+		addr = self.tivo.tivoAddr()
+		if addr is None:
+			self.finish()
+			return
+		seq = self.nextSeq()
+		def listed(videoList):
+			self.listedVideos(seq, videoList)
+			self.finish()
+		self.runInExecutor(lambda: self.listVideos(addr, seq), listed)
 
 ###############################################################################
 class TivoVideo(Asset):
+	__slots__ = ('details', 'links', 'tivoId', 'server')
+	INDEXES = { 'server': None, 'showid': None, 'programid': None, 'title': base.foldCase }
+
 	def __init__(self, tivoId, server, attr):
 		Asset.__init__(self, 'TivoVideo')
 		self.details = attr['Details']
@@ -525,12 +614,15 @@ class TivoVideo(Asset):
 			title = '%s (%s)' % (title, formatFilesize(self.details['SourceSize']))
 		return title
 
+	def catalogKey(self):
+		return 'TivoVideo:%s:%s' % (self.server.id, self.tivoId)
+
 	def satisfies(self, require):
 		if self.type != require.type:
 			return False
 		if not isinstance(require, AssetPlaceholder):
 			return self == require
-		if 'id' in require.attr and not isinstance(require.attr['server'], base.TransformPlaceholder) and require.attr['server'] != self.server.id:
+		if 'server' in require.attr and not isinstance(require.attr['server'], base.TransformPlaceholder) and require.attr['server'] != self.server.id:
 			return False
 		if 'showid' in require.attr and not isinstance(require.attr['showid'], base.TransformPlaceholder) and require.attr['showid'] != self.showId():
 			return False
@@ -547,71 +639,400 @@ class DownloadTivoVideo(Transform):
 	SPEC.requires = [AssetPlaceholder('TivoVideo', {'server': SPEC.locks[0].id })]
 	SPEC.produces = [AssetPlaceholder('TivoVideoDownload', {'mediaKey': SPEC.locks[0].mediaKey, '!isFile':1, 'fileExt':'tivo' })]
 	
-	def __init__(self):
+	def __init__(self, useLoop = False, storage = None):
 		Transform.__init__(self)
+		self.useLoop = useLoop			# copy on the controller's IoLoop workers rather than a thread of our own
+		self.storage = storage			# a StoragePool to put outputs in, which lets us make our own when we aren't given one
 	
 	def spec(self):
 		return self.SPEC
 
+	# what a file we make for video is called, it's given a volume once the task is admitted
+	def outputName(self, video, ext):
+		return '%s.%s' % (video.details['ProgramId'], ext)
+
 	def newTask(self,env,input,output):
 		if input is None:
 			raise TaskLaunchError('inappropriate input arguments')
 		if output is None:
-			raise TaskLaunchError('inappropriate output arguments')
+			if self.storage is None:
+				raise TaskLaunchError('inappropriate output arguments')
+			output = (TivoVideoDownload(self.outputName(input[0], 'tivo'), None),)
 		infile = input[0]
 		outfile = output[0]
 		mediaKey = infile.server.mediaKey
 		#self.fetchFile(mediaKey, infile, outfile)
-		tempAttr = dict(infile.details)
-		if 'ContentType' in tempAttr:
-			del tempAttr['ContentType']
-		if 'SourceFormat' in tempAttr:
-			del tempAttr['SourceFormat']
-		if 'SourceSize' in tempAttr:
-			del tempAttr['SourceSize']
-		if 'ByteOffset' in tempAttr:
-			del tempAttr['ByteOffset']
-		for attr in tempAttr:
-			outfile.details[attr] = tempAttr[attr]
+		outfile.details.update(self.downloadDetails(infile))
 		outfile.mediaKey = mediaKey
 
+		# nothing is opened until the task is admitted, the server lock is what keeps us to one stream per tivo
+		query = TivoServerQuery(mediaKey)
+		if self.useLoop:
+			return TivoDownloadAsyncTask(self, outfile, infile, query, env, self.storage)
+		return TivoDownloadTask(self, outfile, infile, query, env, self.storage)
+	def isRunning(self,tasks,input,output):
+		if input is None:
+			raise TaskLaunchError('inappropriate input arguments')
+		for task in tasks:
+			if task.video == input[0] and task.status in (task.tsQUEUED, task.tsRUNNING):
+				return True
+		return False
+	# the video's details that still hold for the downloaded file
+	def downloadDetails(self, video):
+		tempAttr = dict(video.details)
+		for attr in ('ContentType', 'SourceFormat', 'SourceSize', 'ByteOffset'):
+			if attr in tempAttr:
+				del tempAttr[attr]
+		return tempAttr
+
+	# a decoder that reads from stdin can take the download as it arrives
+	def canFuse(self, consumer):
+		return hasattr(consumer, 'streamArgs')
+	def fuse(self, consumer, env, input, output, intermediate = None):
+		if input is None:
+			raise TaskLaunchError('inappropriate input arguments')
+		if output is None:
+			if self.storage is None:
+				raise TaskLaunchError('inappropriate output arguments')
+			output = (MpegVideo(self.outputName(input[0], 'mpg')),)
+		video = input[0]
+		outfile = output[0]
+		mediaKey = video.server.mediaKey
+		details = self.downloadDetails(video)
+		if intermediate is not None:
+			intermediate.details.update(details)
+			intermediate.mediaKey = mediaKey
+		if 'Duration' in details:
+			del details['Duration']
+		outfile.details.update(details)
+
 		query = TivoServerQuery(mediaKey)
-		req = query.openSimplePath(query.crackUrl(infile.links['Content']['Url']))
-		file = outfile.open('wb')
-		return TivoDownloadTask(outfile, req, file, infile.server, env)
+		def openSource():
+			src = query.openSimplePath(query.crackUrl(video.links['Content']['Url']))
+			if intermediate is not None:
+				return TeeReader(src, intermediate.open('wb'))
+			return src
+		def decoded(tool):
+			if intermediate is not None:
+				env.declareAsset(intermediate)
+			env.declareAsset(outfile)
+		return TivoStreamDecodeTask(self, consumer, video, outfile, input, decoded, openSource, self.storage)
 
-class FileCopyTask(ThreadTask):
+class TeeReader(object):
+	"""Reads from src, writing everything read to copy as well, for keeping what's streamed through a task"""
+	def __init__(self, src, copy):
+		self.src = src
+		self.copy = copy
+	def read(self, size = -1):
+		buf = self.src.read(size)
+		self.copy.write(buf)
+		return buf
+	def close(self):
+		try:
+			self.src.close()
+		finally:
+			self.copy.close()
+
+class PlacedOutput(object):
+	"""Holds room in a StoragePool for the task's output while it runs.  An output named without a directory
+	goes on whichever volume the pool picks as the task is admitted, and the task waits while none has room."""
+	storage = None
+	placement = None
+	def reserve(self):
+		if self.storage is None:
+			return True
+		size = self.video.details.get('SourceSize', 0)
+		if os.path.dirname(self.asset.filename):
+			self.placement = self.storage.reserve(self.asset.filename, size)
+		else:
+			self.placement = self.storage.place(self.asset.filename, size)
+			if self.placement is not None:
+				self.asset.filename = self.placement.filename
+		return self.placement is not None
+	def unreserve(self):
+		if self.placement is not None:
+			self.placement.release()
+			self.placement = None
+
+class TivoStreamDecodeTask(PlacedOutput, task.ToolTask):
+	"""A download piped straight into its decoder, so it holds a tivo's stream and a cpu together"""
+	SLOTS = { 'net': 1, 'cpu': 1 }
+	def __init__(self, xform, consumer, video, asset, input, onComplete, source, storage = None):
+		self.consumer = consumer
+		self.video = video
+		self.asset = asset
+		task.ToolTask.__init__(self, xform, self.command(), input, onComplete, source=source)
+		self.server = video.server
+		self.storage = storage
+	def command(self):
+		return [self.consumer.toolCommand()] + list(self.consumer.streamArgs(self.video.server.mediaKey, self.asset))
+	def start(self, tasks = None):
+		self.args = self.command()		# the output may only just have been given a volume
+		task.ToolTask.start(self, tasks)
+	def cost(self):
+		return self.video.details.get('SourceSize', 0)
+
+class StreamCopy(object):
+	"""Copies src to dest a block at a time, shared by the threaded and event loop copy tasks.  The block size
+	follows the link, growing while blocks come quickly and shrinking while they're slow, so a fast link isn't
+	held up by per-block overhead and a slow one still reports progress and notices cancelling promptly."""
+	MIN_BLOCK = 64*1024
+	MAX_BLOCK = 16*1024*1024
+	BLOCK_TIME = 0.25			# seconds we'd like each block to take
+	def name(self):
+		return "Stream Copy Task: %s" % self.asset
+	def openStreams(self):
+		pass
+	def beginCopy(self):
+		self.openStreams()
+		self.engine = copyengine.CopyEngine(self.src, self.dest)
+		self.progressChanged(self.offset, self.size, True)
+		return True
+	def moveBlock(self):
+		return self.engine.copy(self.block)
+	def copyBlock(self):
+		start = time.time()
+		moved = self.moveBlock()
+		if not moved:
+			print "%s: %d bytes copied by %s" % (self.name(), self.offset, self.engine.path)
+			self.progressChanged(self.offset, self.size, True)
+			return False
+		self.offset += moved
+		self.adaptBlock(moved, time.time() - start)
+		self.progressChanged(self.offset, self.size)
+		self.blockWritten()
+		return True
+	def adaptBlock(self, count, elapsed):
+		if count < self.block:
+			return			# a short read is the end of the stream, not a measure of the link
+		if elapsed < self.BLOCK_TIME / 2:
+			self.block = min(self.block * 2, self.MAX_BLOCK)
+		elif elapsed > self.BLOCK_TIME * 2:
+			self.block = max(self.block // 2, self.MIN_BLOCK)
+	def blockWritten(self):
+		pass
+	def closeStreams(self):
+		if self.src is not None:
+			self.src.close()
+		if self.dest is not None:
+			self.dest.close()
+	def copyDone(self):
+		pass
+
+class FileCopyTask(StreamCopy, ThreadTask):
 	def __init__(self, asset, src, dest):
 		ThreadTask.__init__(self)
 		self.asset = asset
 		self.src = src
 		self.dest = dest
 		self.block = 1024*1024
-	def name(self):
-		return "Stream Copy Task: %s" % self.asset
+		self.offset = 0				# bytes in dest
+		self.size = 0				# bytes we expect in all, 0 if we don't know
+		self.engine = None
 	def stop(self):
 		self.threadStatus = ThreadTask.thrCANCELLING
 	def run(self):
 		try:
+			self.beginCopy()
 			while self.threadStatus == ThreadTask.thrRUNNING:
-				buf = self.src.read(self.block)
-				if not buf:
+				if not self.copyBlock():
 					break
-				self.dest.write(buf)
 		finally:
-			self.src.close()
-			self.dest.close()
+			self.closeStreams()
+		if self.active():
+			self.copyDone()
 
-class TivoDownloadTask(FileCopyTask):
-	def __init__(self, asset, src, dest, server, env):
-		FileCopyTask.__init__(self, asset, src, dest)
-		self.server = server
+class AsyncFileCopyTask(StreamCopy, AsyncTask):
+	"""Each block is read and written on one of the loop's workers rather than a thread of our own.  A block
+	holds its worker until it's moved (or the socket times out), so this bounds the threads copies use rather
+	than doing without them: the controller sizes the pool by its net slot limit, which is what bounds how
+	many copies run at once."""
+	def __init__(self, asset, src, dest):
+		AsyncTask.__init__(self)
+		self.asset = asset
+		self.src = src
+		self.dest = dest
+		self.block = 1024*1024
+		self.offset = 0
+		self.size = 0
+		self.engine = None
+		self.inFlight = False
+		self.streamsOpen = True
+	def begin(self):
+		self.inFlight = True
+		self.loop.runInExecutor(self.beginCopy, self.blockCopied)
+	def cleanup(self):
+		if not self.inFlight:		# otherwise blockCopied closes them once the worker lets go
+			self.closeStreams()
+	def closeStreams(self):
+		if self.streamsOpen:
+			self.streamsOpen = False
+			StreamCopy.closeStreams(self)
+
+	def nextBlock(self):
+		self.inFlight = True
+		self.loop.runInExecutor(self.copyBlock, self.blockCopied)
+	def blockCopied(self, more, error):
+		self.inFlight = False
+		if not self.active():
+			self.closeStreams()
+		elif error is not None:
+			traceback.print_exception(*error)
+			self.finish(task.Task.tsFAILED)
+		elif more:
+			self.nextBlock()
+		else:
+			self.closeStreams()
+			self.copyDone()
+			self.finish()
+
+class DownloadCheckpoint(object):
+	"""The .part file beside a download in progress, recording how much of it is known to be on disk.  It names
+	what's being downloaded, so a partial file left by some other recording is never added to."""
+	def __init__(self, filename, source):
+		self.target = filename
+		self.filename = filename + '.part'
+		self.source = source
+	# how many bytes of the target can be kept
+	def load(self):
+		try:
+			with open(self.filename, 'r') as f:
+				state = json.load(f)
+			size = os.path.getsize(self.target)
+		except (IOError, OSError, ValueError):
+			return 0
+		if not isinstance(state, dict) or state.get('source') != self.source:
+			return 0
+		return max(0, min(state.get('offset', 0), size))
+	def save(self, offset):
+		temp = self.filename + '.new'
+		with open(temp, 'w') as f:
+			json.dump({'source': self.source, 'offset': offset}, f)
+		if os.name == 'nt' and os.path.exists(self.filename):
+			os.remove(self.filename)		# no atomic replace there
+		os.rename(temp, self.filename)
+	def remove(self):
+		try:
+			os.remove(self.filename)
+		except OSError:
+			pass
+
+class TivoDownload(PlacedOutput):
+	"""Downloads pick up where the last attempt stopped: the file is appended to from the checkpointed
+	offset, and a dropped stream is reopened with a Range request a few times before we give up.  The rest
+	of the file is preallocated as we start, so downloads running side by side don't fragment each other."""
+	SLOTS = { 'net': 1 }
+	CHECKPOINT_INTERVAL = 16*1024*1024		# bytes written between checkpoints
+	RETRIES = 5								# reconnects in a row without progress before failing
+	RETRY_DELAY = 1.0						# seconds, multiplied by the attempt number
+	def cost(self):
+		return self.video.details.get('SourceSize', 0)
+	def openStreams(self):
+		url = urlparse.urlparse(self.video.links['Content']['Url'])
+		self.checkpoint = DownloadCheckpoint(self.asset.filename, '%s?%s' % (url.path, url.query))	# the tivo's address may change
+		self.offset = self.checkpoint.load()
+		self.saved = self.offset
+		self.size = self.video.details.get('SourceSize', 0)
+		self.retries = 0
+		self.dest = self.asset.open('ab')
+		self.dest.truncate(self.offset)		# anything past the checkpoint may not have made it to disk
+		storage.preallocate(self.dest, self.offset, self.size - self.offset)
+		self.connect()
+	def connect(self):
+		try:
+			self.src = self.query.openSimplePath(self.query.crackUrl(self.video.links['Content']['Url']), self.offset)
+		except urllib2.HTTPError as e:
+			if e.code != 416 or not self.offset:
+				raise
+			# nothing past our offset: done already if that's the whole of it ('bytes */<size>'), otherwise start again
+			total = (e.info().getheader('Content-Range') or '').rpartition('/')[2]
+			e.close()
+			if total.isdigit() and int(total) != self.offset:
+				print "%s: partial file doesn't match the server's, starting again" % self.name()
+				self.offset = self.saved = 0
+				self.dest.truncate(0)
+				return self.connect()
+			self.src = cStringIO.StringIO()
+			self.end = None
+			return
+		if self.offset and self.src.getcode() != 206:
+			print "%s: server ignored the range, starting again" % self.name()
+			self.offset = self.saved = 0
+			self.dest.truncate(0)
+		length = self.src.info().getheader('Content-Length')
+		self.end = None
+		if length is not None:
+			self.end = self.offset + int(length)
+			self.size = self.end			# better than SourceSize, which is only an estimate
+	def moveBlock(self):
+		while True:
+			try:
+				moved = self.engine.copy(self.block)
+			except (IOError, socket.error, httplib.HTTPException) as e:
+				if not self.reconnect(e):
+					return 0
+				continue
+			if not moved and self.end is not None and self.offset < self.end:
+				if not self.reconnect(IOError('stream ended at %d of %d bytes' % (self.offset, self.end))):
+					return 0
+				continue
+			if moved:
+				self.retries = 0
+			return moved
+	def blockWritten(self):
+		if self.offset - self.saved >= self.CHECKPOINT_INTERVAL:
+			self.saveCheckpoint()
+	def reconnect(self, error):
+		self.src.close()
+		self.saveCheckpoint()
+		while self.retries < self.RETRIES and self.active():
+			self.retries += 1
+			print "%s: lost the stream at %d bytes (%s), resuming" % (self.name(), self.offset, error)
+			time.sleep(self.RETRY_DELAY * self.retries)
+			try:
+				self.connect()
+				self.engine = copyengine.CopyEngine(self.src, self.dest)
+				return True
+			except (IOError, socket.error, httplib.HTTPException) as e:
+				error = e
+		if not self.active():
+			return False		# cancelled, what we have is checkpointed
+		raise error
+	def saveCheckpoint(self):
+		self.dest.flush()
+		os.fsync(self.dest.fileno())
+		self.checkpoint.save(self.offset)
+		self.saved = self.offset
+	def closeStreams(self):
+		if self.dest is not None and not self.dest.closed:
+			self.saveCheckpoint()
+			self.dest.truncate(self.offset)		# gives back whatever was preallocated past the end
+		super(TivoDownload, self).closeStreams()
+	def copyDone(self):
+		self.checkpoint.remove()
+		self.env.declareAsset(self.asset)
+	def transform(self):
+		return self.xform
+
+class TivoDownloadTask(TivoDownload, FileCopyTask):
+	def __init__(self, xform, asset, video, query, env, storage = None):
+		FileCopyTask.__init__(self, asset, None, None)
+		self.xform = xform
+		self.video = video
+		self.server = video.server
+		self.query = query
 		self.env = env
-	def run(self):
-		FileCopyTask.run(self)
-		if self.status == task.Task.tsRUNNING:
-			self.env.declareAsset(self.asset)
-	
+		self.storage = storage
+
+class TivoDownloadAsyncTask(TivoDownload, AsyncFileCopyTask):
+	def __init__(self, xform, asset, video, query, env, storage = None):
+		AsyncFileCopyTask.__init__(self, asset, None, None)
+		self.xform = xform
+		self.video = video
+		self.server = video.server
+		self.query = query
+		self.env = env
+		self.storage = storage
 
 class FileAsset(Asset):
 	def __init__(self, type, filename):
@@ -621,6 +1042,10 @@ class FileAsset(Asset):
 		return self.filename
 	def open(self, mode):
 		return open(self.filename, mode)
+	def catalogKey(self):
+		return '%s:%s' % (self.type, self.filename)
+	def revalidate(self):
+		return os.path.isfile(self.filename)
 
 class TivoVideoDownload(FileAsset):
 	def __init__(self, filename, mediaKey):
@@ -634,6 +1059,17 @@ class TivoVideoDownload(FileAsset):
 			return self == require
 		return True
 
+class MpegVideo(FileAsset):
+	def __init__(self, filename):
+		FileAsset.__init__(self, 'MpegVideo', filename)
+		self.details = {}
+	def satisfies(self, require):
+		if self.type != require.type:
+			return False
+		if not isinstance(require, AssetPlaceholder):
+			return self == require
+		return True
+
 ###############################################################################
 
 class DecryptTivoVideoDSD(base.ToolchainTransform):
@@ -646,18 +1082,18 @@ class DecryptTivoVideoDSD(base.ToolchainTransform):
 		return self.SPEC
 		
 	def newTask(self,env,input,output):
-		if input is not None:
+		if input is None:
 			raise TaskLaunchError('inappropriate input arguments')
-		if output is not None:
+		if output is None:
 			raise TaskLaunchError('inappropriate output arguments')
 		infile = input[0]
 		outfile = output[0]
-		self.callTool(self.toolPath + ' -s "%s" -t "%s"' % (infile.filePath, outfile.filePath))
 		tempAttr = dict(infile.details)
 		if 'Duration' in tempAttr:
 			del tempAttr['Duration']
 		for attr in tempAttr:
-			outfile.meta[attr] = tempAttr[attr]
+			outfile.details[attr] = tempAttr[attr]
+		return self.callTool(['-s', infile.filename, '-t', outfile.filename], input, lambda tool: env.declareAsset(outfile))
 
 class DecryptTivoVideoTD(base.ToolchainTransform):
 	SPEC = base.TransformSpec()
@@ -669,18 +1105,21 @@ class DecryptTivoVideoTD(base.ToolchainTransform):
 		return self.SPEC
 		
 	def newTask(self,env,input,output):
-		if input is not None:
+		if input is None:
 			raise TaskLaunchError('inappropriate input arguments')
-		if output is not None:
+		if output is None:
 			raise TaskLaunchError('inappropriate output arguments')
 		infile = input[0]
 		outfile = output[0]
-		self.callTool(self.toolPath + ' --mak "%s" --out "%s" "%s"' % (infile.mediaKey, outfile.filePath, infile.filePath))
 		tempAttr = dict(infile.details)
 		if 'Duration' in tempAttr:
 			del tempAttr['Duration']
 		for attr in tempAttr:
-			outfile.meta[attr] = tempAttr[attr]
+			outfile.details[attr] = tempAttr[attr]
+		return self.callTool(['--mak', infile.mediaKey, '--out', outfile.filename, infile.filename], input, lambda tool: env.declareAsset(outfile))
+	# the arguments to decode from stdin instead of a file, which lets a download be fused with us
+	def streamArgs(self, mediaKey, outfile):
+		return ['--mak', mediaKey, '--out', outfile.filename, '-']
 
 ###############################################################################
 
@@ -697,8 +1136,7 @@ task.avail_transforms.add(DecryptTivoVideoTD())
 
 ###############################################################################
 if __name__ == '__main__':
-	import taskui
-	env = task.ObservableEnvironment()
+	import taskui, catalog
 	
 #	goalAsset = base.AssetPlaceholder('MpegVideo', {'title':'Mythbusters'})
 	goalAsset = base.AssetPlaceholder('TivoVideoDownload', base.FrozenDict({'title':'Mythbusters'}))
@@ -707,12 +1145,24 @@ if __name__ == '__main__':
 	expanseAsset = base.AssetPlaceholder('TivoVideo', {'title':'The Expanse'})
 	wormholeAsset = base.AssetPlaceholder('TivoVideo', {'title':'Through the Wormhole With Morgan Freeman'})
 
+	rootDir = 'h:\\makestage\\'
+	storagePool = storage.StoragePool(sys.argv[1:] or [rootDir])		# volumes to spread downloads over
+	for xform in task.avail_transforms:
+		if isinstance(xform, DownloadTivoVideo):
+			xform.storage = storagePool
+	env = catalog.CatalogEnvironment(rootDir + 'catalog.db')
 	goal = task.Goal(goalAsset)
 	tasks = task.TaskController(env)
-	goalTask = task.GoalTask(env, goal)
+	goalTask = task.GoalTask(env, goal, cache=task.ChainCache(rootDir + 'chains.db'))
 	tasks.addTask(goalTask)
 	downloadTask = None
-	rootDir = 'h:\\makestage\\'
+
+	# the download only has a volume once it's admitted, and its details go beside it
+	def writeMetadata(observers, msg):
+		if msg.type == task.Notification.ntSTATUS and msg.value == task.Task.tsRUNNING:
+			metaFile = open(os.path.splitext(msg.task.asset.filename)[0] + '.json', 'w')
+			metaFile.write(json.dumps(msg.task.video.details))
+			metaFile.close()
 
 	taskui.threadFrameTest(env, tasks)
 	try:
@@ -753,12 +1203,12 @@ if __name__ == '__main__':
 					#video = videos[key]
 					if video.satisfies(mythAsset) or video.satisfies(futuramaAsset) or video.satisfies(expanseAsset) or video.satisfies(wormholeAsset):
 						id = video.details['ProgramId']
-						videoAsset = TivoVideoDownload(rootDir + id + '.tivo', video.server.id)
-						if not os.path.isfile(videoAsset.filename):
-							metaFile = open(rootDir + id + '.json', 'w')
-							metaFile.write(json.dumps(video.details))
-							metaFile.close()
-							downloadTask = DownloadTivoVideo().newTask(env,(video,),(videoAsset,))
+						videoAsset = TivoVideoDownload(id + '.tivo', video.server.id)
+						existing = storagePool.find(videoAsset.filename)
+						if existing is None or os.path.exists(existing + '.part'):		# a partial one is resumed where it is
+							downloadTask = DownloadTivoVideo(storage=storagePool).newTask(env,(video,),(videoAsset,))
+							downloadTask.addObserver(writeMetadata)
+							downloadTask.claim(DownloadTivoVideo.SPEC, (video, video.server))
 							tasks.addTask(downloadTask)
 							break
 #					showID = video.showId()
@@ -784,3 +1234,4 @@ if __name__ == '__main__':
 	finally:
 		print "Requesting shutdown..."
 		tasks.stop()
+		env.close()